@@ -0,0 +1,105 @@
+"""
+Runs many synthesis jobs in one process (or one pool of processes).
+
+A job is a dict with a `program` (the sketch), `inputs` and `outputs`, and
+optionally `withExprs`, `options` (keyword arguments of synthesize) and an
+`id`. As a script it reads one job per line of JSONL and writes one result
+per line:
+
+    python -m while_lang.batch jobs.jsonl -o results.jsonl --workers 4
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import sys
+import time
+
+from while_lang.wp import PartialResult, ResultCache, synthesize
+
+batch_worker_state = {}
+
+
+def init_batch_worker(defaults, cache_path):
+    # one cache connection per process, SQLite connections do not survive a fork
+    batch_worker_state['defaults'] = defaults
+    batch_worker_state['cache'] = None if cache_path is None else ResultCache(cache_path)
+
+
+def describe_result(result):
+    if isinstance(result, PartialResult):
+        return {'status': 'partial', 'phase': result.phase, 'tried': result.tried, 'pending': result.pending}
+    if result == "timeout":
+        return {'status': 'timeout'}
+    if result == "solution can't be found":
+        return {'status': 'no_solution'}
+    return {'status': 'ok', 'program': result}
+
+
+def run_job(indexed_job):
+    index, job = indexed_job
+    record = {'index': index}
+    if 'id' in job:
+        record['id'] = job['id']
+    options = dict(batch_worker_state['defaults'], **job.get('options', {}))
+    if batch_worker_state['cache'] is not None:
+        options.setdefault('cache', batch_worker_state['cache'])
+    options['stats'] = stats = {}
+    started = time.monotonic()
+    try:
+        # synthesize reports its progress on stdout, which is where the results go
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = synthesize(job['program'], job.get('inputs', {}), job.get('outputs', {}),
+                                job.get('withExprs', True), **options)
+        record.update(describe_result(result))
+        record['stats'] = stats
+    except Exception as e:
+        record.update(status='error', error=f'{type(e).__name__}: {e}')
+    record['seconds'] = time.monotonic() - started
+    return record
+
+
+def synthesize_batch(jobs, workers=1, cache=None, **defaults):
+    """
+    Runs the jobs and yields a result record for each as soon as it is done:
+    its `index` in `jobs` (and `id`, if the job has one), a `status` (ok,
+    no_solution, timeout, partial or error), the `program` when it is ok,
+    the search `stats` and the `seconds` it took. With several workers the
+    records come in the order the jobs finish. `cache` is the path of a
+    ResultCache shared by the jobs; `defaults` are options for every job,
+    which a job's own options override.
+    """
+    if workers <= 1:
+        init_batch_worker(defaults, cache)
+        yield from map(run_job, enumerate(jobs))
+        return
+    with multiprocessing.get_context('fork').Pool(workers, initializer=init_batch_worker,
+                                                  initargs=(defaults, cache)) as pool:
+        yield from pool.imap_unordered(run_job, enumerate(jobs))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Synthesize a JSONL stream of sketches.")
+    parser.add_argument('jobs', nargs='?', default='-', help="JSONL file of jobs, - for stdin (default)")
+    parser.add_argument('-o', '--output', default='-', help="JSONL file for the results, - for stdout (default)")
+    parser.add_argument('-j', '--workers', type=int, default=1, help="number of worker processes")
+    parser.add_argument('--cache', help="path of a result cache database")
+    parser.add_argument('--deadline', type=float, help="seconds allowed per job")
+    parser.add_argument('--portfolio', help="comma separated solver strategies to race on every query")
+    args = parser.parse_args(argv)
+
+    defaults = {} if args.deadline is None else {'deadline': args.deadline}
+    if args.portfolio is not None:
+        defaults['portfolio'] = args.portfolio.split(',')
+    with contextlib.ExitStack() as files:
+        source = sys.stdin if args.jobs == '-' else files.enter_context(open(args.jobs))
+        sink = sys.stdout if args.output == '-' else files.enter_context(open(args.output, 'w'))
+        jobs = (json.loads(line) for line in source if line.strip())
+        for record in synthesize_batch(jobs, args.workers, args.cache, **defaults):
+            sink.write(json.dumps(record) + '\n')
+            sink.flush()
+
+
+if __name__ == '__main__':
+    main()
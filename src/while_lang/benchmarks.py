@@ -1,8 +1,21 @@
+import json
+import os
+import tempfile
 import unittest
+from unittest import mock
 
 from z3 import And, simplify, Implies, Or
 
-from wp import synthesize, synthesizeAndVerify
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from batch import main as batch_main, synthesize_batch
+from syntax import WhileParser
+from wp import PartialResult, ResultCache, synthesize, synthesizeAndVerify, verify, CandidateStream, SOLVER_STRATEGIES, \
+    eval_columns, \
+    eval_op_columns, expr_fingerprint, point_columns, prune_equivalent_candidates, sample_points
 
 
 class Feature1NoVer(unittest.TestCase):
@@ -311,6 +324,439 @@ class AdditionalFeature2And5(unittest.TestCase):
         self.assertEqual("a:=1; b:= 1; i := 0 ; n:= 5;" \
                   " while i < n do ( tmp:= a ; a := a + b; b:= tmp; i:= i + 1)", new_prog)
 
+class IncrementalSession(unittest.TestCase):
+    def test_sameResultAsFreshSolver(self):
+        program = '''a:=c;
+                b:=??;
+                while b >0 do (
+                    a:= a + 1 ;
+                    b:= ??);
+                assert a = (c + 2)'''
+        res = synthesize(program, {}, {}, True, incremental=True)
+        self.assertEqual(synthesize(program, {}, {}, True, incremental=False), res)
+
+class ParallelSearch(unittest.TestCase):
+    def test_deterministicMatchesSequential(self):
+        program = "a:=1; b:= 1; i := 0 ; n:= 5;" \
+                  " while i < n do ( tmp:= ?? ; a := a + b; b:= ??; i:= i + 1)"
+        new_prog = synthesize(program, {}, {"a": 13}, True, workers=4, deterministic=True)
+        self.assertEqual("a:=1; b:= 1; i := 0 ; n:= 5;" \
+                  " while i < n do ( tmp:= a ; a := a + b; b:= tmp; i:= i + 1)", new_prog)
+
+    def test_firstFound(self):
+        program = '''a:=2  ; c:= ?? ; assert c= (b * 2)'''
+        res = synthesize(program, {}, {}, True, workers=4, deterministic=False).strip()
+        self.assertIn(res, ['a:=2  ; c:= 2*b ; assert c= (b * 2)', 'a:=2  ; c:= b*2 ; assert c= (b * 2)',
+                            'a:=2  ; c:= b + b ; assert c= (b * 2)', 'a:=2  ; c:= a*b ; assert c= (b * 2)',
+                            'a:=2  ; c:= b*a ; assert c= (b * 2)'])
+
+class Cegis(unittest.TestCase):
+    def test_constHole(self):
+        program = '''a := ??;b := a + a;a := ??; assert a = 6; assert b = 6'''
+        res = synthesize(program, {}, {}, False, backend='cegis').strip()
+        self.assertEqual('''a := 3;b := a + a;a := 6; assert a = 6; assert b = 6''', res)
+
+    def test_noSol(self):
+        program = '''a := ??;b := a + a; assert a =6; assert b = 6'''
+        res = synthesize(program, {}, {}, False, backend='cegis').strip()
+        self.assertEqual("solution can't be found", res)
+
+    def test_exprReportsIterations(self):
+        program = '''a:=1  ; c:= ?? ; assert c= (b + 1)'''
+        stats = {}
+        res = synthesize(program, {}, {}, True, backend='cegis', stats=stats).strip()
+        self.assertIn(res, ['a:=1  ; c:= b + a ; assert c= (b + 1)', "a:=1  ; c:= 1 + b ; assert c= (b + 1)"])
+        self.assertEqual('cegis', stats['backend'])
+        self.assertGreaterEqual(stats['cegis_iterations'], stats['checks'])
+
+    def test_loop(self):
+        program = '''a:=c;
+                b:=??;
+                while b >0 do (
+                    a:= a + 1 ;
+                    b:= b+ ??);
+                assert a = (c + 2)'''
+        res = synthesize(program, {}, {}, True, backend='cegis')
+        self.assertEqual(synthesize(program, {}, {}, True), res)
+
+class ObservationalEquivalence(unittest.TestCase):
+    def test_fewerChecksSameResult(self):
+        program = '''a:=2  ; c:= ?? ; assert c= (b * b)'''
+        plain, pruned = {}, {}
+        res = synthesize(program, {}, {}, True, break_symmetry=False, stats=plain)
+        self.assertEqual(res, synthesize(program, {}, {}, True, prune_equivalent=True, break_symmetry=False,
+                                         stats=pruned))
+        self.assertEqual('a:=2  ; c:= b*b ; assert c= (b * b)', res)
+        self.assertLess(pruned['checks'], plain['checks'])
+
+    def test_withInputs(self):
+        program = '''c:= ?? ; d := c + (a - b)'''
+        res = synthesize(program, {"a": 3, "b": 4}, {"d": 6}, True, prune_equivalent=True)
+        self.assertEqual('c:= 7 ; d := c + (a - b)', res)
+
+class ResumableSearch(unittest.TestCase):
+    def test_resumeFromCheckpoint(self):
+        program = '''a:=1  ; c:= ?? ; assert c=b'''
+        path = os.path.join(tempfile.mkdtemp(), 'search.json')
+        with open(path, 'w') as f:  # as if a previous run got through phase 0 without a solution
+            json.dump({'program': program, 'names': ['a', 'c', 'b'], 'phase': 1, 'index': 0}, f)
+        stats = {}
+        res = synthesize(program, {}, {}, True, checkpoint=path, stats=stats)
+        self.assertEqual('a:=1  ; c:= b ; assert c=b', res)
+        self.assertEqual(1, stats['phase'])  # found again as hole0_0 + b
+        self.assertFalse(os.path.exists(path))
+
+    def test_checkpointOfOtherProgramIgnored(self):
+        program = '''a:=1  ; c:= ?? ; assert c=b'''
+        path = os.path.join(tempfile.mkdtemp(), 'search.json')
+        with open(path, 'w') as f:
+            json.dump({'program': 'c:= ??', 'names': ['c'], 'phase': 1, 'index': 0}, f)
+        self.assertEqual('a:=1  ; c:= b ; assert c=b', synthesize(program, {}, {}, True, checkpoint=path))
+
+class DecomposedSearch(unittest.TestCase):
+    def test_sixHoles(self):
+        program = "a:=??; b:=??; c:=??; d:=??; e:=??; f:=??; assert a = x; assert b = (a + 1);" \
+                  " assert c = (b * x); assert d = (c - a); assert e = 7; assert f = (e + d)"
+        stats = {}
+        res = synthesize(program, {}, {}, True, search='decomposed', stats=stats,
+                         candidate_timeout=2000)  # Z3 can get stuck on some of the partial queries
+        self.assertTrue(res.startswith("a:=x; "))
+        self.assertIn("e:=7;", res)
+        self.assertLess(stats['checks'], 1000)
+
+    def test_loop(self):
+        program = "a:=1; b:= 1; i := 0 ; n:= 5;" \
+                  " while i < n do ( tmp:= ?? ; a := a + b; b:= ??; i:= i + 1)"
+        new_prog = synthesize(program, {}, {"a": 13}, True, search='decomposed')
+        self.assertEqual("a:=1; b:= 1; i := 0 ; n:= 5;" \
+                  " while i < n do ( tmp:= a ; a := a + b; b:= tmp; i:= i + 1)", new_prog)
+
+class MemoizedWp(unittest.TestCase):
+    def test_branchesJoinOnce(self):
+        ast = WhileParser()("if a > 0 then b := 1 else b := 1 ; if b > 0 then c := 2 else c := 2 ;"
+                            " if c > 0 then d := 3 else d := 3")
+        stats = {}
+        self.assertTrue(verify(lambda d: True, ast, lambda d: d['d'] == 3, stats=stats))
+        self.assertLess(stats['wp_built'], stats['wp_calls'])
+        self.assertLess(stats['formula_dag_size'], stats['formula_tree_size'])
+
+    def test_synthesisStats(self):
+        stats = {}
+        res = synthesize("a := ?? ; b := 0 ; while a > 0 do ( b := b + 2 ; a := a - 1 )", {}, {"b": 6},
+                         True, stats=stats)
+        self.assertEqual("a := 3 ; b := 0 ; while a > 0 do ( b := b + 2 ; a := a - 1 )", res)
+        self.assertGreater(stats['formula_dag_size'], 0)
+
+class PassiveEncoding(unittest.TestCase):
+    def test_linearInBranches(self):
+        ast = WhileParser()(" ; ".join("if b > %d then b := b + %d else b := b - 1" % (i, i) for i in range(12)))
+        sizes = {}
+        for encoding in ['wp', 'passive']:
+            stats = {}
+            self.assertTrue(verify(lambda d: d['b'] == 20, ast, lambda d: d['b'] >= 20, stats=stats,
+                                   encoding=encoding))
+            sizes[encoding] = stats['formula_tree_size']
+        self.assertLess(sizes['passive'] * 100, sizes['wp'])
+
+    def test_counterexample(self):
+        ast = WhileParser()("if a > 0 then b := a else b := 0 - a ; if b > 3 then c := 1 else c := 0")
+        self.assertFalse(verify(lambda d: True, ast, lambda d: d['c'] == 1, encoding='passive'))
+
+    def test_deepUnroll(self):
+        program = "a := ?? ; b := 0 ; while a > 0 do ( if b > 4 then b := b + 2 else b := b + 1 ; a := a - 1 )"
+        res = synthesize(program, {}, {"b": 15}, True, encoding='passive', unroll_depth=12)
+        self.assertEqual("a := 10 ; b := 0 ; while a > 0 do ( if b > 4 then b := b + 2 else b := b + 1 ;"
+                         " a := a - 1 )", res)
+
+class IterativeDeepening(unittest.TestCase):
+    def test_stopsAtNeededDepth(self):
+        program = "a := ?? ; b := 0 ; while a > 0 do ( b := b + 1 ; a := a - 1 )"
+        stats = {}
+        self.assertEqual(synthesize(program, {}, {"b": 3}, False),
+                         synthesize(program, {}, {"b": 3}, False, deepen=True, stats=stats))
+        self.assertEqual([3], stats['unroll_depths'])
+
+    def test_beyondFixedDepth(self):
+        program = "a := ?? ; b := 0 ; while a > 0 do ( if b > 4 then b := b + 2 else b := b + 1 ; a := a - 1 )"
+        stats = {}
+        res = synthesize(program, {}, {"b": 15}, True, deepen=True, encoding='passive', stats=stats)
+        self.assertEqual("a := 10 ; b := 0 ; while a > 0 do ( if b > 4 then b := b + 2 else b := b + 1 ;"
+                         " a := a - 1 )", res)
+        self.assertEqual([10], stats['unroll_depths'])
+
+    def test_perLoopDepth(self):
+        program = "a := ?? ; b := 0 ; while a > 0 do ( b := b + 2 ; a := a - 1 ) ; c := 0 ; while c < a do c := c + 1"
+        stats = {}
+        res = synthesize(program, {}, {"b": 4, "c": 0}, False, deepen=True, stats=stats)
+        self.assertTrue(res.startswith("a := 2 ;"))
+        self.assertEqual([2, 1], stats['unroll_depths'])
+
+class Deadline(unittest.TestCase):
+    def test_partialResult(self):
+        program = "a := ?? ; b := 0 ; while a > 0 do ( b := b + 2 ; a := a - 1 ) ; assert b = (c * (c * c))"
+        stats = {}
+        res = synthesize(program, {}, {"b": 3}, True, deadline=1, candidate_timeout=200, stats=stats)
+        self.assertIsInstance(res, PartialResult)
+        self.assertTrue(stats['deadline_hit'])
+        self.assertEqual(stats['tried'], res.tried)
+        self.assertGreater(res.tried, 0)
+        self.assertLess(res.elapsed, 5)
+
+    def test_timedOutCandidatesRetried(self):
+        program = 'c:= ?? ; d := c + (a - b)'
+        stats = {}
+        res = synthesize(program, {"a": 3, "b": 4}, {"d": 6}, True, candidate_rlimit=1, retry_factor=1000,
+                         max_phase=1, concrete_filter=False, stats=stats)
+        self.assertEqual('c:= 7 ; d := c + (a - b)', res)
+        self.assertGreater(stats['checks'], stats['tried'])
+        self.assertFalse(stats['deadline_hit'])
+
+class CachedResults(unittest.TestCase):
+    def test_hitAcrossRunsAndLayouts(self):
+        path = os.path.join(tempfile.mkdtemp(), 'results.db')
+        stats = {}
+        cache = ResultCache(path)
+        self.assertEqual('c:= 7 ; d := c + (a - b)',
+                         synthesize('c:= ?? ; d := c + (a - b)', {"a": 3, "b": 4}, {"d": 6}, cache=cache, stats=stats))
+        self.assertEqual('miss', stats['cache'])
+        cache.close()
+        cache = ResultCache(path)
+        self.assertEqual('c:=7;  d := c + (a - b)',
+                         synthesize('c:=??;  d := c + (a - b)', {"b": 4, "a": 3}, {"d": 6}, cache=cache, stats=stats))
+        self.assertEqual('hit', stats['cache'])
+        self.assertEqual({'cache_hits': 1, 'cache_misses': 0, 'cache_evictions': 0}, cache.counters())
+
+    def test_negativeResults(self):
+        program = '''a := ?? ; b := a ; assert b = (a + 1)'''
+        for cache_negative, second in [(False, 'miss'), (True, 'hit')]:
+            cache = ResultCache(':memory:', cache_negative=cache_negative)
+            for expected in ['miss', second]:
+                stats = {}
+                self.assertEqual("solution can't be found",
+                                 synthesize(program, {}, {}, False, cache=cache, stats=stats))
+                self.assertEqual(expected, stats['cache'])
+
+    def test_leastRecentlyUsedEvicted(self):
+        cache = ResultCache(':memory:', max_bytes=200)
+        for value in [1, 2, 1, 3]:
+            synthesize('a := ??', {}, {"a": value}, False, cache=cache)
+        stats = {}
+        synthesize('a := ??', {}, {"a": 1}, False, cache=cache, stats=stats)
+        self.assertEqual('hit', stats['cache'])
+        synthesize('a := ??', {}, {"a": 2}, False, cache=cache, stats=stats)
+        self.assertEqual('miss', stats['cache'])
+        self.assertGreater(cache.evictions, 0)
+
+class Batch(unittest.TestCase):
+    jobs = [{"id": "expr", "program": "c:= ?? ; d := c + (a - b)", "inputs": {"a": 3, "b": 4}, "outputs": {"d": 6}},
+            {"program": "a := ??;b := a + a", "outputs": {"a": 6, "b": 6}, "withExprs": False},
+            {"program": "a := "}]
+
+    def test_records(self):
+        records = list(synthesize_batch(self.jobs))
+        self.assertEqual([0, 1, 2], [r['index'] for r in records])
+        self.assertEqual("expr", records[0]['id'])
+        self.assertEqual(('ok', 'c:= 7 ; d := c + (a - b)'), (records[0]['status'], records[0]['program']))
+        self.assertEqual('no_solution', records[1]['status'])
+        self.assertEqual('error', records[2]['status'])
+
+    def test_workers(self):
+        records = list(synthesize_batch(self.jobs * 2, workers=2))
+        self.assertEqual(list(range(6)), sorted(r['index'] for r in records))
+        self.assertEqual(['ok', 'no_solution', 'error'] * 2,
+                         [r['status'] for r in sorted(records, key=lambda r: r['index'])])
+
+    def test_jsonl(self):
+        directory = tempfile.mkdtemp()
+        source, sink = os.path.join(directory, 'jobs.jsonl'), os.path.join(directory, 'results.jsonl')
+        with open(source, 'w') as f:
+            f.writelines(json.dumps(job) + '\n' for job in self.jobs[:2])
+        batch_main([source, '-o', sink, '--cache', os.path.join(directory, 'results.db')])
+        batch_main([source, '-o', sink, '--cache', os.path.join(directory, 'results.db')])
+        with open(sink) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(['ok', 'no_solution'], [r['status'] for r in records])
+        self.assertEqual('hit', records[0]['stats']['cache'])
+        self.assertIn('seconds', records[1])
+
+class MultipleExamples(unittest.TestCase):
+    def test_generalizes(self):
+        program = 'z := x ; y := ??'
+        self.assertEqual('z := x ; y := 2', synthesize(program, {"x": 1}, {"y": 2}))
+        self.assertIn(synthesize(program, [({"x": 1}, {"y": 2}), ({"x": 3}, {"y": 6})]),
+                      ['z := x ; y := 2*x', 'z := x ; y := 2*z'])  # the variable order comes from a set
+
+    def test_sharedConstant(self):
+        program = 'y := (x + x) + ??'
+        examples = [({"x": 1}, {"y": 3}), ({"x": 2}, {"y": 5}), ({"x": 5}, {"y": 11})]
+        for options in [{}, {'backend': 'cegis'}, {'encoding': 'passive'}]:
+            self.assertEqual('y := (x + x) + 1', synthesize(program, examples, **options))
+        self.assertEqual("solution can't be found",
+                         synthesize(program, examples + [({"x": 0}, {"y": 0})], withExprs=False))
+
+    def test_loop(self):
+        program = 'a := ?? ; b := 0 ; while a > 0 do ( b := b + x ; a := a - 1 )'
+        res = synthesize(program, [({"x": 1}, {"b": 3}), ({"x": 2}, {"b": 6})], withExprs=False)
+        self.assertEqual('a := 3 ; b := 0 ; while a > 0 do ( b := b + x ; a := a - 1 )', res)
+
+class ConcreteFilter(unittest.TestCase):
+    def test_fewerSolverChecks(self):
+        program = 'y := ?? ; z := y + x ; v := w'
+        examples = [({"x": 1, "w": 2}, {"z": 3}), ({"x": 3, "w": 5}, {"z": 18}), ({"x": 2, "w": -1}, {"z": 0})]
+        filtered, unfiltered = {}, {}
+        self.assertEqual('y := w*x ; z := y + x ; v := w', synthesize(program, examples, stats=filtered))
+        self.assertEqual('y := w*x ; z := y + x ; v := w',
+                         synthesize(program, examples, concrete_filter=False, stats=unfiltered))
+        self.assertGreater(filtered['concrete_rejected'], 0)
+        self.assertEqual(filtered['tried'], unfiltered['tried'])
+        self.assertLess(filtered['checks'], unfiltered['checks'])
+
+    def test_outOfFuelLeftToSolver(self):
+        program = 'i := 0 ; while i < x do i := i + ?? ; z := i'
+        stats = {}
+        res = synthesize(program, {"x": 3}, {"z": 3}, True, fuel=50, stats=stats)
+        self.assertIn(res, ['i := 0 ; while i < x do i := i + 1 ; z := i',
+                            'i := 0 ; while i < x do i := i + 3 ; z := i'])
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class VectorizedEvaluation(unittest.TestCase):
+    names = ['a', 'b']
+    examples = [{'a': a, 'b': b} for a in range(-3, 4) for b in range(-3, 4)]
+
+    def test_matchesScalar(self):
+        points = sample_points(self.names, self.examples)
+        columns = point_columns(points)
+        cache = {}
+        for (val,) in CandidateStream(self.names, ['h'], max_phase=3):
+            values, valid = eval_columns(val.tree, *columns, cache)
+            self.assertEqual(expr_fingerprint(val.tree, points),
+                             tuple(int(v) if ok else None for v, ok in zip(values, valid)), str(val.tree))
+
+    def test_overflowMasked(self):
+        big = numpy.array([2 ** 62, 2 ** 62, -2 ** 63, 5], dtype=numpy.int64)
+        for op, other, expected in [('+', [2 ** 62, -1, -1, 1], [True, False, True, False]),
+                                    ('-', [-2 ** 62, 1, 1, 6], [True, False, True, False]),
+                                    ('*', [2, -2, -1, 3], [True, False, True, False]),
+                                    ('/', [0, -1, -1, -2], [True, False, True, False])]:
+            _, undefined = eval_op_columns(op, big, numpy.array(other, dtype=numpy.int64))
+            self.assertEqual(expected, list(undefined), op)
+        values, _ = eval_op_columns('/', numpy.array([7, -7, 7, -7]), numpy.array([2, 2, -2, -2]))
+        self.assertEqual([3, -4, -3, 4], list(values))  # Z3's division
+
+    def test_samePruning(self):
+        points = sample_points(self.names, self.examples)
+        kept = []
+        for vectorized in [False, True]:
+            seen = {}
+            kept.append([[str(val.tree) for val in candidate] for phase_num in range(2) for candidate in
+                         prune_equivalent_candidates(CandidateStream(self.names, ['h0', 'h1']).generate(phase_num),
+                                                     phase_num, points, seen, vectorized, chunk=100)])
+        self.assertEqual(kept[0], kept[1])
+        self.assertLess(len(kept[1]), sum(1 for _ in CandidateStream(self.names, ['h0', 'h1'], max_phase=2)))
+
+    def test_manyExamples(self):
+        program = 'c := ?? ; d := c + a ; b := b'
+        examples = [({'a': a, 'b': b}, {'d': a * b + a}) for a in range(1, 6) for b in range(-2, 4)]
+        self.assertIn(synthesize(program, examples, prune_equivalent=True),
+                      ['c := a*b ; d := c + a ; b := b', 'c := b*a ; d := c + a ; b := b'])
+
+class Portfolio(unittest.TestCase):
+    def test_recordsWinner(self):
+        stats = {}
+        self.assertEqual('a := 3 ; b := a + a', synthesize('a := ?? ; b := a + a', {}, {'b': 6}, False,
+                                                          portfolio=['default', 'qe'], stats=stats))
+        self.assertEqual(1, sum(stats['portfolio_wins'].values()))
+        self.assertLessEqual(set(stats['portfolio_wins']), {'default', 'qe'})
+        self.assertEqual("solution can't be found",
+                         synthesize('a := ?? ; b := a + a', {}, {'b': 7}, False, portfolio=True))
+
+    def test_expressions(self):
+        stats = {}
+        res = synthesize('y := ?? ; z := y + x', {'x': 2}, {'z': 6}, True, portfolio=True, stats=stats)
+        self.assertEqual('y := 4 ; z := y + x', res)
+        self.assertEqual(stats['tried'] - stats['concrete_rejected'], sum(stats['portfolio_wins'].values()))
+
+    def test_undecidedStrategyLoses(self):
+        with mock.patch.dict(SOLVER_STRATEGIES, starved=((), {'rlimit': 1})):
+            stats = {}
+            self.assertTrue(verify(lambda d: d['a'] >= 0, WhileParser()('while a > 0 do a := a - 1'),
+                                   lambda d: d['a'] == 0, lambda d: d['a'] >= 0, stats=stats,
+                                   portfolio=['starved', 'default']))
+            self.assertEqual({'default': 1}, stats['portfolio_wins'])
+            self.assertFalse(verify(lambda d: d['a'] >= 0, WhileParser()('while a > 0 do a := a - 2'),
+                                    lambda d: d['a'] == 0, lambda d: d['a'] >= 0, portfolio=['starved', 'default']))
+        with self.assertRaises(ValueError):
+            verify(lambda d: True, WhileParser()('a := 1'), lambda d: d['a'] == 1, portfolio=['starved'])
+
+    def test_batch(self):
+        jobs = [{'program': 'a := ?? ; b := a + a', 'outputs': {'b': 6}, 'withExprs': False}] * 2
+        records = list(synthesize_batch(jobs, workers=2, portfolio=['default', 'qe']))
+        self.assertEqual(['ok', 'ok'], [record['status'] for record in records])
+        self.assertEqual([1, 1], [sum(record['stats']['portfolio_wins'].values()) for record in records])
+
+class Preprocessing(unittest.TestCase):
+    def test_eliminatesQuantifiers(self):
+        program = 'a := ??;n:=2;while a >0 do (n:= n + 1; a:= a - 1)'
+        stats = {}
+        self.assertEqual(synthesize(program, {}, {"n": 9, "a": 0}, False),
+                         synthesize(program, {}, {"n": 9, "a": 0}, False, preprocess=True, stats=stats))
+        self.assertEqual(1, stats['preprocess']['eliminated'])
+        self.assertLess(stats['preprocess']['size_after'], stats['preprocess']['size_before'])
+
+    def test_eliminatedHolesKeepTheirValues(self):
+        # solve-eqs takes `a` out of the query, its value comes back through the model converter
+        self.assertEqual('a := 3;b := a + a', synthesize('a := ??;b := a + a', {}, {"b": 6}, False,
+                                                        preprocess=True))
+        self.assertEqual('y := 4 ; z := y + x', synthesize('y := ?? ; z := y + x', {'x': 2}, {'z': 6}, True,
+                                                           preprocess=['simplify', 'qe2', 'solve-eqs']))
+
+    def test_fallsBackToRawQuery(self):
+        program = 'y := ?? ; z := y * x'
+        stats = {}
+        self.assertEqual('y := 0 ; z := y * x', synthesize(program, {}, {"z": 0}, False, preprocess=['simplify'],
+                                                           stats=stats))
+        self.assertEqual({'queries': 1, 'eliminated': 0}, {k: stats['preprocess'][k] for k in ['queries', 'eliminated']})
+
+    def test_verify(self):
+        loop = lambda step: WhileParser()(f'while a > 0 do a := a - {step}')
+        P, Q, linv = lambda d: d['a'] >= 0, lambda d: d['a'] == 0, lambda d: d['a'] >= 0
+        stats = {}
+        self.assertTrue(verify(P, loop(1), Q, linv, stats=stats, preprocess=True))
+        self.assertEqual(1, stats['preprocess']['eliminated'])
+        self.assertFalse(verify(P, loop(2), Q, linv, preprocess=True))
+
+class SymmetryBreaking(unittest.TestCase):
+    names = ['a', 'b', 'c']
+
+    def test_noMirroredOrConstantCandidates(self):
+        phase = [val.tree for (val,) in CandidateStream(self.names, ['h']).generate(1)]
+        exprs = {(t.root, str(t.subtrees[0]), str(t.subtrees[1])) for t in phase}
+        for op, left, right in exprs:
+            if op in '+*':
+                self.assertNotIn((op, right, left), exprs - {(op, left, left)})
+            self.assertFalse(op in '-/' and left == right, (op, left, right))
+            self.assertTrue('id' in left + right, (op, left, right))
+        self.assertNotIn(('-', 'id{a}', 'const{h_1}'), exprs)  # a + h_1 with the opposite constant
+        self.assertNotIn(('+', 'id{a}', 'const{h_1}'), exprs)
+        self.assertIn(('+', 'const{h_0}', 'id{a}'), exprs)
+
+    def test_phasesShrink(self):
+        for holes in [['h'], ['h0', 'h1']]:
+            for phase_num in [1, 2]:
+                plain = sum(1 for _ in CandidateStream(self.names, holes, break_symmetry=False).generate(phase_num))
+                broken = sum(1 for _ in CandidateStream(self.names, holes).generate(phase_num))
+                self.assertLess(broken, plain * 0.7)
+
+    def test_sameResultsFewerChecks(self):
+        program = 'c := ?? ; d := c + a ; b := b'
+        examples = [({'a': a, 'b': b}, {'d': a * b + a}) for a in range(1, 4) for b in range(-2, 2)]
+        plain, broken = {}, {}
+        expected = ['c := a*b ; d := c + a ; b := b', 'c := b*a ; d := c + a ; b := b']
+        self.assertIn(synthesize(program, examples, break_symmetry=False, concrete_filter=False, stats=plain),
+                      expected)
+        self.assertIn(synthesize(program, examples, concrete_filter=False, stats=broken), expected)
+        self.assertLess(broken['checks'], plain['checks'])
+
 class SynthFailed(unittest.TestCase):
     def test_numOfIterationsWhile2(self):
         program = "i:=??; n:= 1; a := b - 1 ;" \
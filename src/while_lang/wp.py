@@ -1,15 +1,35 @@
+import hashlib
+import json
 import multiprocessing
+import multiprocessing.connection
+import os
+import random
+import signal
+import sqlite3
+import threading
+import time
 from while_lang.syntax import WhileParser
 import adt.tree
 import operator
-from z3 import Int, ForAll, Implies, Not, And, Or, Solver, unsat, sat, simplify, z3printer
+from z3 import Int, Bool, ForAll, Implies, Not, And, Or, Solver, unsat, sat, unknown, simplify, z3printer, Function, IntSort, \
+    BoolSort, BoolVal, IntVal, Var, Goal, Model, Tactic, Then, TryFor, Z3Exception, substitute_funs, substitute, is_const, is_var, is_quantifier, \
+    is_and, is_true, is_false, is_expr, is_int_value, Z3_OP_UNINTERPRETED
 from copy import copy, deepcopy
 from functools import partial
-from itertools import product
+from itertools import islice, product
+
+try:
+    import numpy
+except ImportError:  # optional, only speeds up the equivalence pruning
+    numpy = None
+
+
+class SynthesisTimeout(Exception):
+    pass
 
 
 def signal_handler(signum, frame):
-    raise Exception("Timed out!")
+    raise SynthesisTimeout("Timed out!")
 
 
 z3printer
@@ -41,8 +61,22 @@ def mk_env(pvars):
     return LazyDict({v: Int(v) for v in pvars})
 
 
+shared_parser = []
+
+
+def parse(program: str):
+    # one parser, and so one grammar, serves every call
+    if not shared_parser:
+        shared_parser.append(WhileParser())
+    return shared_parser[0](program)
+
+
+def example_env(pvars, i):
+    return LazyDict({v: Int(f'{v}!ex{i}') for v in pvars})
+
+
 def getVars(program: str):
-    ast = WhileParser()(program)
+    ast = parse(program)
     return find_all_vars(ast)
 
 
@@ -71,14 +105,167 @@ def find_all_vars(ast):
     return list(set(sons_vars))
 
 
-def solve(formulas):
+def solve(formulas, portfolio=None, wins=None, preprocess=None, counters=None):
     # print((formulas[0]))
+    subgoals = preprocess_query(formulas, preprocess, counters) if preprocess else None
+    if subgoals is not None:
+        for goal in subgoals:
+            model = solve(list(goal), portfolio, wins)
+            if model is not None:
+                return goal.convert_model(model)  # with the values of the variables the tactics eliminated
+        return None
+    if portfolio:
+        return solve_portfolio(formulas, portfolio, wins)
     s = Solver()
     s.add(formulas)
     if s.check() == sat:
         return s.model()
 
 
+DEFAULT_PREPROCESS = ['simplify', 'qe', 'simplify', 'solve-eqs']
+PREPROCESS_TIMEOUT = 200  # ms, a chain taking longer counts as failed
+
+
+def has_quantifier(formula):
+    todo, seen = [formula], set()
+    while todo:
+        f = todo.pop()
+        if is_quantifier(f):
+            return True
+        if f.get_id() not in seen:
+            seen.add(f.get_id())
+            todo.extend(f.children())
+    return False
+
+
+def preprocess_query(formulas, tactics, counters=None):
+    """
+    Runs a chain of tactics (True for DEFAULT_PREPROCESS) on a query, to
+    turn its ForAlls into a quantifier free problem. Returns the resulting
+    subgoals (the query is sat iff one of them is), or None if a tactic
+    failed or a quantifier is left, in which case the raw query should be
+    solved instead. The DAG sizes of the query before and after are added
+    up in `counters`, with how many queries were (or were not) eliminated.
+    """
+    tactics = DEFAULT_PREPROCESS if tactics is True else list(tactics)
+    goal = Goal()
+    goal.add(formulas)
+    try:
+        chain = Then(*tactics) if len(tactics) > 1 else Tactic(tactics[0])
+        subgoals = list(TryFor(chain, PREPROCESS_TIMEOUT)(goal))
+    except Z3Exception:
+        subgoals = None
+    eliminated = subgoals is not None and not any(has_quantifier(f) for g in subgoals for f in g)
+    if counters is not None:
+        counters['queries'] = counters.get('queries', 0) + 1
+        counters['eliminated'] = counters.get('eliminated', 0) + eliminated
+        counters['size_before'] = counters.get('size_before', 0) + formula_size(goal.as_expr())[0]
+        counters['size_after'] = counters.get('size_after', 0) + \
+            (formula_size(Or(*[g.as_expr() for g in subgoals]))[0] if eliminated else formula_size(goal.as_expr())[0])
+    return subgoals if eliminated else None
+
+
+# name -> (tactics run before the solver, solver parameters)
+SOLVER_STRATEGIES = {
+    'default': ((), {}),
+    'no-mbqi': ((), {'smt.mbqi': False}),
+    'qe': (('qe', 'smt'), {}),
+    'nlsat': (('qe', 'qfnia'), {}),
+    'seed1': ((), {'random_seed': 1}),
+    'seed2': ((), {'random_seed': 2}),
+}
+
+DEFAULT_PORTFOLIO = ['default', 'qe', 'nlsat', 'seed1']
+
+
+def strategy_solver(name):
+    tactics, params = SOLVER_STRATEGIES[name]
+    if len(tactics) > 1:
+        solver = Then(*tactics).solver()
+    else:
+        solver = Tactic(tactics[0]).solver() if tactics else Solver()
+    solver.set(**params)
+    return solver
+
+
+def run_strategy(name, formulas):
+    """
+    Checks the formulas with one strategy of the portfolio. Returns the
+    status as a string and, if sat, the values of the constants in the
+    model (only the Int and Bool ones, which is all the queries have).
+    """
+    solver = strategy_solver(name)
+    solver.add(formulas)
+    status = solver.check()
+    values = []
+    if status == sat:
+        model = solver.model()
+        for decl in model.decls():
+            value = model[decl]
+            if decl.arity() == 0 and (is_int_value(value) or is_true(value) or is_false(value)):
+                values.append((decl.name(), value.as_long() if is_int_value(value) else is_true(value)))
+    return str(status), values
+
+
+def solve_portfolio(formulas, portfolio, wins=None):
+    """
+    Races the strategies named in `portfolio` (True for DEFAULT_PORTFOLIO,
+    see SOLVER_STRATEGIES) on the same query, each in a forked process, and
+    kills the rest once one of them answers sat or unsat. The model of a sat
+    answer is rebuilt in this process. The name of the winning strategy is
+    counted in `wins`; if none of them could decide the query the result is
+    None, as for an unknown from `solve`.
+    """
+    names = DEFAULT_PORTFOLIO if portfolio is True else list(portfolio)
+    unknown_names = [name for name in names if name not in SOLVER_STRATEGIES]
+    if unknown_names:
+        raise ValueError(f"unknown solver strategies: {', '.join(unknown_names)}")
+    racers = {}
+    try:
+        for name in names:
+            # plain fork rather than a Process: the batch workers are daemons, which cannot have children
+            receive, send = multiprocessing.Pipe(duplex=False)
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    receive.close()
+                    send.send(run_strategy(name, formulas))
+                finally:
+                    os._exit(0)
+            send.close()
+            racers[receive] = (name, pid)
+
+        pending = list(racers)
+        while pending:
+            for receive in multiprocessing.connection.wait(pending):
+                pending.remove(receive)
+                try:
+                    status, values = receive.recv()
+                except EOFError:  # the strategy crashed
+                    continue
+                if status == 'unknown':
+                    continue
+                name = racers[receive][0]
+                if wins is not None:
+                    wins[name] = wins.get(name, 0) + 1
+                if status == 'unsat':
+                    return None
+                model = Model()
+                for const, value in values:
+                    model.update_value(Bool(const) if isinstance(value, bool) else Int(const),
+                                       BoolVal(value) if isinstance(value, bool) else IntVal(value))
+                return model
+        return None
+    finally:
+        for receive, (_, pid) in racers.items():
+            receive.close()
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            os.waitpid(pid, 0)
+
+
 def encode_expr(ast, env):
     global generated_div_non_zero_div_cond
     if ast.root == 'id':
@@ -86,6 +273,8 @@ def encode_expr(ast, env):
         return env[ast.subtrees[0].root], generated_div_non_zero_div_cond[0]
     elif ast.root == 'num':
         return ast.subtrees[0].root, True
+    elif ast.root == 'const':
+        return Int(ast.subtrees[0].root), True
     elif ast.root in OP:
         left_expr, zero_div_cond1 = encode_expr(ast.subtrees[0], env)
         right_expr, zero_div_cond2 = encode_expr(ast.subtrees[1], env)
@@ -104,11 +293,11 @@ def encode_expr(ast, env):
         raise SyntaxError
 
 
-def get_wp(ast, Q, linv):
+def build_wp(ast, Q, linv, cache=None):
     if ast.root == ';':
         def concat_lambda(e):
-            wp_second = get_wp(ast.subtrees[1], Q, linv)  # assert a==2
-            wp_first = get_wp(ast.subtrees[0], wp_second, linv)  # a := 1
+            wp_second = get_wp(ast.subtrees[1], Q, linv, cache)  # assert a==2
+            wp_first = get_wp(ast.subtrees[0], wp_second, linv, cache)  # a := 1
             return wp_first(e)
 
         return concat_lambda
@@ -128,8 +317,8 @@ def get_wp(ast, Q, linv):
 
     elif ast.root == 'if':
         def if_lambda(e):
-            wp_then = get_wp(ast.subtrees[1], Q, linv)
-            wp_else = get_wp(ast.subtrees[2], Q, linv)
+            wp_then = get_wp(ast.subtrees[1], Q, linv, cache)
+            wp_else = get_wp(ast.subtrees[2], Q, linv, cache)
             cond, zero_div = encode_expr(ast.subtrees[0], e)
             if zero_div is True:
                 return Or(And(cond, wp_then(e)), And(Not(cond), wp_else(e)))
@@ -144,7 +333,7 @@ def get_wp(ast, Q, linv):
             unassigned_vars = [v for v in e.keys() if v not in get_assigned_vars(ast)]
             for var in unassigned_vars:
                 new_env = upd(new_env, var, e[var])
-            wp = get_wp(ast.subtrees[1], linv, linv)
+            wp = get_wp(ast.subtrees[1], linv, linv, cache)
             cond, zero_div = encode_expr(ast.subtrees[0], new_env)
             first_cond, first_zero_div = encode_expr(ast.subtrees[0], e)
             return And(Implies(first_cond, And(linv(e),
@@ -169,8 +358,195 @@ def get_wp(ast, Q, linv):
 
         return lambda_assert
 
+    elif ast.root == 'bound':
+        # the innermost loop left by a bounded unrolling: if its bound literal is
+        # assumed, the runs that still need more iterations are accepted as they are
+        wp_loop = get_wp(ast.subtrees[0], Q, linv, cache)
+
+        def lambda_bound(e):
+            cond, _ = encode_expr(ast.subtrees[0].subtrees[0], e)
+            return Or(And(Bool(ast.subtrees[1].root), cond), wp_loop(e))
+
+        return lambda_bound
+
+
+def get_wp(ast, Q, linv, cache=None):
+    if cache is not None:
+        return cache.transformer(ast, Q, linv)
+    return build_wp(ast, Q, linv)
 
-def verify(P, ast, Q, linv=None):
+
+def env_key(e):
+    # environments are compared by content: Z3 hash-conses terms, so equal values have equal ids
+    return tuple((name, val.get_id() if is_expr(val) else val if isinstance(val, (int, bool)) else id(val))
+                 for name, val in sorted(dict.items(e)))
+
+
+class WPCache:
+    """
+    Memoizes get_wp for one query. The transformer of an (AST node,
+    postcondition) pair is built once instead of inside every call of its
+    parent, and the formula it returns for an environment is built once per
+    distinct environment (the cache keeps the environments alive, so the
+    term ids in their keys stay valid).
+    """
+
+    def __init__(self):
+        self.transformers = {}
+        self.calls = 0
+        self.built = 0
+
+    def transformer(self, ast, Q, linv):
+        key = (id(ast), id(Q), id(linv))
+        if key not in self.transformers:
+            wp = build_wp(ast, Q, linv, self)
+            results = {}
+
+            def memo_wp(e):
+                self.calls += 1
+                k = env_key(e)
+                if k not in results:
+                    self.built += 1
+                    results[k] = (e, wp(e))
+                return results[k][1]
+
+            self.transformers[key] = (ast, Q, linv, memo_wp)
+        return self.transformers[key][3]
+
+    def counters(self):
+        return {'wp_calls': self.calls, 'wp_built': self.built, 'wp_transformers': len(self.transformers)}
+
+
+def formula_size(formula):
+    """
+    Returns the number of distinct nodes of a formula (its size as Z3 stores
+    it) and its size as a tree, with every shared subterm counted again.
+    """
+    tree_sizes = {}
+    todo = [formula]
+    while todo:
+        e = todo[-1]
+        if e.get_id() in tree_sizes:
+            todo.pop()
+            continue
+        children = [e.body()] if is_quantifier(e) else [] if is_var(e) else e.children()
+        missing = [c for c in children if c.get_id() not in tree_sizes]
+        if missing:
+            todo += missing
+        else:
+            todo.pop()
+            tree_sizes[e.get_id()] = 1 + sum(tree_sizes[c.get_id()] for c in children)
+    return len(tree_sizes), tree_sizes[formula.get_id()]
+
+
+def same_value(a, b):
+    if is_expr(a) or is_expr(b):
+        return is_expr(a) and is_expr(b) and a.eq(b)
+    return a is b or (isinstance(a, int) and isinstance(b, int) and a == b)
+
+
+def conj(*formulas):
+    formulas = [f for f in formulas if f is not True]
+    return And(*formulas) if len(formulas) != 1 else formulas[0]
+
+
+class PassiveEncoder:
+    """
+    Builds the verification condition of a program in passive form. Instead
+    of handing the whole rest of the program to both branches of an `if`
+    (as get_wp does), every variable the branches disagree on gets a fresh
+    auxiliary constant at the join point, constrained by an equation in
+    each branch, and the rest of the program is encoded once over those
+    constants. The formula therefore grows linearly with the program, also
+    after deep unrolling.
+
+    encode() returns (N, W, env): N relates the initial state to the final
+    state `env` of the command, W says that no assertion or division by
+    zero fails on the way. The auxiliary constants are collected in `aux`
+    and are meant to be quantified together with the program variables.
+    """
+
+    def __init__(self, linv, cache=None, tag=''):
+        self.linv = linv
+        self.cache = cache
+        self.tag = tag
+        self.aux = []
+
+    def fresh(self, name):
+        v = Int(f'{name}!{self.tag}{len(self.aux)}')
+        self.aux.append(v)
+        return v
+
+    def encode(self, ast, e):
+        if ast.root == ';':
+            n1, w1, e = self.encode(ast.subtrees[0], e)
+            n2, w2, e = self.encode(ast.subtrees[1], e)
+            return conj(n1, n2), conj(w1, w2 if n1 is True else Implies(n1, w2)), e
+
+        elif ast.root == 'skip':
+            return True, True, e
+
+        elif ast.root == ':=':
+            expr, zero_div = encode_expr(ast.subtrees[1], e)
+            return True, zero_div, upd(e, ast.subtrees[0].subtrees[0].root, expr)
+
+        elif ast.root == 'assert':
+            expr, zero_div = encode_expr(ast.subtrees[0], e)
+            return True, conj(zero_div, expr), e
+
+        elif ast.root == 'if':
+            cond, zero_div = encode_expr(ast.subtrees[0], e)
+            n1, w1, e1 = self.encode(ast.subtrees[1], e)
+            n2, w2, e2 = self.encode(ast.subtrees[2], e)
+            joined, eqs1, eqs2 = copy(e), [], []
+            for name in dict.keys(e):
+                v1, v2 = dict.__getitem__(e1, name), dict.__getitem__(e2, name)
+                if not same_value(v1, v2):
+                    joined[name] = self.fresh(name)
+                    eqs1.append(joined[name] == v1)
+                    eqs2.append(joined[name] == v2)
+            n = Or(conj(cond, n1, *eqs1), conj(Not(cond), n2, *eqs2))
+            return n, conj(zero_div, Implies(cond, w1), Implies(Not(cond), w2)), joined
+
+        elif ast.root == 'while':
+            # same rule as get_wp: the loop is summarized by its invariant
+            assigned = set(get_assigned_vars(ast))
+            first_cond, first_zero_div = encode_expr(ast.subtrees[0], e)
+            inner, exit_env = copy(e), copy(e)
+            for name in assigned:
+                inner[name] = Int(f'{name}!inv{len(self.aux)}')
+                exit_env[name] = self.fresh(name)
+            body_wp = get_wp(ast.subtrees[1], self.linv, self.linv, self.cache)
+            cond, zero_div = encode_expr(ast.subtrees[0], inner)
+            exit_cond, _ = encode_expr(ast.subtrees[0], exit_env)
+            preserved = ForAll([inner[name] for name in assigned],
+                               And(Implies(And(self.linv(inner), cond), body_wp(inner)),
+                                   Implies(self.linv(inner), zero_div)))
+            skipped = [exit_env[name] == e[name] for name in assigned]
+            n = Or(conj(Not(first_cond), *skipped), conj(first_cond, self.linv(exit_env), Not(exit_cond)))
+            return n, conj(first_zero_div, Implies(first_cond, And(self.linv(e), preserved))), exit_env
+
+        elif ast.root == 'bound':
+            n, w, e2 = self.encode(ast.subtrees[0], e)
+            cond, _ = encode_expr(ast.subtrees[0].subtrees[0], e)
+            bound = Bool(ast.subtrees[1].root)
+            return And(Implies(bound, Not(cond)), n), Or(And(bound, cond), w), e2
+
+        raise SyntaxError
+
+
+def get_passive_vc(ast, Q, linv, env, cache=None, tag=''):
+    """
+    Returns the verification condition of {?} ast {Q} from `env` in passive
+    form, and the auxiliary constants it introduced (their names are marked
+    with `tag`).
+    """
+    encoder = PassiveEncoder(linv, cache, tag)
+    n, w, final_env = encoder.encode(ast, env)
+    return conj(w, Implies(n, Q(final_env)) if n is not True else Q(final_env)), encoder.aux
+
+
+def verify(P, ast, Q, linv=None, stats=None, encoding='wp', portfolio=None, preprocess=None):
     """
     Verifies a Hoare triple {P} c {Q}
     Where P, Q are assertions (see below for examples)
@@ -178,11 +554,29 @@ def verify(P, ast, Q, linv=None):
     Returns `True` iff the triple is valid.
     Also prints the counterexample (model) returned from Z3 in case
     it is not.
+    With encoding='passive' the verification condition is built by
+    PassiveEncoder instead of get_wp. With a `portfolio` the query is
+    raced across solver strategies (see solve_portfolio), with `preprocess`
+    it first goes through a tactic chain (see preprocess_query).
     """
     env = mk_env(find_all_vars(ast))
-    wp = get_wp(ast, Q, linv)
-    # print(wp(env))
-    sol = solve([P(env), Not(wp(env))])
+    cache = WPCache()
+    if encoding == 'passive':
+        # the auxiliary constants stay free: they are existential in the negated query
+        formula, _ = get_passive_vc(ast, Q, linv, env, cache)
+    else:
+        wp = get_wp(ast, Q, linv, cache)
+        # print(wp(env))
+        formula = wp(env)
+    wins, counters = {}, {}
+    sol = solve([P(env), Not(formula)], portfolio, wins, preprocess, counters)
+    if stats is not None:
+        stats.update(cache.counters())
+        stats['formula_dag_size'], stats['formula_tree_size'] = formula_size(formula)
+        if portfolio:
+            stats['portfolio_wins'] = wins
+        if preprocess:
+            stats['preprocess'] = counters
     if sol is not None:
         print("there is a counter example:")
         print(sol)
@@ -208,22 +602,29 @@ def find_and_replace_holes(tree, new_names: list):
     return tree
 
 
-def replace_holes_with_sol(program, hole_names, sol, env):
-    # Input string and list
+def hole_fillings(hole_names, sol, env):
     replacement_list = [str(sol.eval(env[hole])) for hole in hole_names]
-    replacement_list = ['0' if x.startswith("hole") else x for x in
-                        replacement_list]  # default value for all unbonded holes
+    return ['0' if x.startswith("hole") else x for x in
+            replacement_list]  # default value for all unbonded holes
+
+
+def fill_holes(program, replacement_list):
     # Use string formatting to replace "??" with list values
-    fixed_program = program.replace("??", "{}").format(*replacement_list)
+    return program.replace("??", "{}").format(*replacement_list)
+
+
+def replace_holes_with_sol(program, hole_names, sol, env):
+    fixed_program = fill_holes(program, hole_fillings(hole_names, sol, env))
     print(fixed_program)
     return fixed_program
 
 
-def unroll(while_ast, num=7):
+def unroll(while_ast, num=7, bound=None):
     cond = while_ast.subtrees[0]
     body = while_ast.subtrees[1]
 
-    root = adt.tree.Tree("if", [cond, adt.tree.Tree(';', [body, while_ast]), adt.tree.Tree("skip", [])])
+    innermost = while_ast if bound is None else adt.tree.Tree("bound", [while_ast, adt.tree.Tree(bound, [])])
+    root = adt.tree.Tree("if", [cond, adt.tree.Tree(';', [body, innermost]), adt.tree.Tree("skip", [])])
     for i in range(num - 1):
         root = adt.tree.Tree("if", [cond, adt.tree.Tree(';', [body, root]), adt.tree.Tree("skip", [])])
     return root
@@ -232,129 +633,1307 @@ def unroll(while_ast, num=7):
         adt.tree.Tree(name, [])])
 
 
-def preProcess(ast):
+def preProcess(ast, num=7, bounds=None):
+    """
+    Unrolls every (outermost) loop `num` times. If a list `bounds` is given,
+    `num` holds one depth per loop, in program order, and the loop left
+    innermost is marked with a bound literal whose name is appended to
+    `bounds` (see DeepeningSession).
+    """
     if ast.root == 'while':
-        return unroll(ast)
+        if bounds is None:
+            return unroll(ast, num)
+        bounds.append(f'loop{len(bounds)}_bound')
+        return unroll(ast, num[len(bounds) - 1], bounds[-1])
     for i, subtree in enumerate(ast.subtrees):
-        ast.subtrees[i] = preProcess(subtree)
+        ast.subtrees[i] = preProcess(subtree, num, bounds)
     return ast
 
 
-def find_sol(P, ast, Q, linv, env, original_names):
-    wp = get_wp(ast, Q, linv)
-    sol = solve([ForAll([env[n] for n in original_names], Implies(P(env), wp(env)))])
+def count_loops(ast):
+    if ast.root == 'while':
+        return 1
+    return sum(count_loops(subtree) for subtree in ast.subtrees)
+
+
+def find_sol(P, ast, Q, linv, env, original_names, encoding='wp', portfolio=None, wins=None, preprocess=None,
+             counters=None):
+    quantified = [env[n] for n in original_names]
+    if encoding == 'passive':
+        formula, aux = get_passive_vc(ast, Q, linv, env, WPCache())
+        quantified += aux
+    else:
+        wp = get_wp(ast, Q, linv, WPCache())
+        formula = wp(env)
+    sol = solve([ForAll(quantified, Implies(P(env), formula))], portfolio, wins, preprocess, counters)
     return sol
 
 
+def get_free_consts(formula):
+    """
+    Returns the uninterpreted constants occurring in a formula
+    (variables bound by a quantifier are not constants and are skipped).
+    """
+    consts = {}
+    seen = set()
+    todo = [formula]
+    while todo:
+        e = todo.pop()
+        if is_var(e) or e.get_id() in seen:
+            continue
+        seen.add(e.get_id())
+        if is_quantifier(e):
+            todo.append(e.body())
+        elif is_const(e) and e.decl().kind() == Z3_OP_UNINTERPRETED:
+            consts[str(e)] = e
+        else:
+            todo += e.children()
+    return list(consts.values())
+
+
+def get_app_names(formula):
+    # the names of every function and constant applied in a formula
+    names = set()
+    seen = set()
+    todo = [formula]
+    while todo:
+        e = todo.pop()
+        if is_var(e) or e.get_id() in seen:
+            continue
+        seen.add(e.get_id())
+        if is_quantifier(e):
+            todo.append(e.body())
+        else:
+            names.add(e.decl().name())
+            todo += e.children()
+    return names
+
+
+def flatten_conjuncts(formula):
+    if is_and(formula):
+        return [c for child in formula.children() for c in flatten_conjuncts(child)]
+    return [] if is_true(formula) else [formula]
+
+
+class SynthesisSession:
+    """
+    Keeps one Z3 solver alive for the whole candidate search of a sketch.
+    The WP of the sketch (together with P and the division side conditions)
+    is encoded once, with every hole standing for an uninterpreted
+    function of the program variables. Each candidate is then plugged into
+    that template with `substitute_funs` and checked under push/pop.
+
+    With backend='cegis' a candidate is checked by counterexample guided
+    synthesis instead of a single ForAll query: a synthesis query over the
+    concrete inputs collected so far proposes values for the hole constants,
+    and a verification query either accepts them or returns a new input.
+    The inputs are kept for the whole session, so counterexamples found for
+    one candidate prune the next ones as well.
+    """
+
+    def __init__(self, P, ast, Q, linv, original_names, hole_names, backend='forall', max_cegis_iterations=30,
+                 encoding='wp', reuse=None):
+        self.original_names = original_names
+        self.hole_names = hole_names
+        self.backend = backend
+        self.max_cegis_iterations = max_cegis_iterations
+        # a session for another unrolling of the same sketch lends its solver, WP cache and inputs
+        self.solver = Solver() if reuse is None else reuse.solver
+        self.checks = 0
+        self.cegis_iterations = 0
+        self.examples = [] if reuse is None else reuse.examples
+        # deadline (time.monotonic), timeout (ms) and rlimit of every check, see solver_params
+        self.limits = {} if reuse is None else reuse.limits
+        # the tactic chain run on every ForAll query (see preprocess_query), and its counters
+        self.preprocess = None if reuse is None else reuse.preprocess
+        self.preprocess_counters = {} if reuse is None else reuse.preprocess_counters
+        self.last_status = None
+        sorts = [IntSort()] * len(original_names)
+        self.hole_funcs = {hole: Function(f'{hole}_fn', *sorts, IntSort()) for hole in hole_names}
+        self.div_funcs = {hole: Function(f'{hole}_div', *sorts, BoolSort()) for hole in hole_names}
+        # the arguments of a hole function, as seen by its replacement
+        self.bound_env = LazyDict({name: Var(i, IntSort()) for i, name in enumerate(original_names)})
+
+        self.wp_cache = WPCache() if reuse is None else reuse.wp_cache
+        self.quantified = []
+        specs = list(zip(P, Q)) if isinstance(P, list) else [(P, Q)]
+        assumptions, posts = [], []
+        for i, (p, q) in enumerate(specs):
+            # several examples: each gets its own copy of the program variables, the holes are shared
+            env = mk_env(original_names + hole_names) if len(specs) == 1 else example_env(original_names, i)
+            for hole in hole_names:
+                env[hole] = partial(self.hole_app, hole)
+            self.quantified += [env[n] for n in original_names]
+            assumptions.append(p(env))
+            if encoding == 'passive':
+                post, aux = get_passive_vc(ast, q, linv, env, self.wp_cache, tag='' if len(specs) == 1 else f'ex{i}_')
+                self.quantified += aux
+            else:
+                wp = get_wp(ast, q, linv, self.wp_cache)
+                post = wp(env)
+            posts.append(post)
+        if len(specs) == 1:
+            self.assumption, self.post = assumptions[0], posts[0]
+        else:
+            self.assumption = BoolVal(True)
+            self.post = And(*[Implies(a, post) for a, post in zip(assumptions, posts)])
+        self.template = Implies(self.assumption, self.post)
+
+    def hole_app(self, hole, e):
+        global generated_div_non_zero_div_cond
+        args = [e[name] for name in self.original_names]
+        generated_div_non_zero_div_cond[0] = self.div_funcs[hole](*args)
+        return self.hole_funcs[hole](*args)
+
+    def split_conjuncts(self):
+        """
+        The top-level conjuncts of the WP, each with the set of holes it
+        mentions. ForAll distributes over them, so any subset of them can be
+        checked on its own.
+        """
+        names = {}
+        for hole in self.hole_names:
+            names[self.hole_funcs[hole].name()] = hole
+            names[self.div_funcs[hole].name()] = hole
+        return [(c, {names[n] for n in get_app_names(c) if n in names}) for c in flatten_conjuncts(self.post)]
+
+    def instantiate(self, candidate, conjuncts=None):
+        """
+        Plugs a candidate into the template. The candidate is a sequence of
+        expressions (one per hole) or a dict assigning some of the holes; if
+        `conjuncts` is given only they are kept from the WP.
+        """
+        global generated_div_non_zero_div_cond
+        formula = self.template if conjuncts is None else Implies(self.assumption, And(*conjuncts))
+        substitutions = []
+        for hole, val in (candidate.items() if isinstance(candidate, dict) else zip(self.hole_names, candidate)):
+            generated_div_non_zero_div_cond[0] = True
+            expr = val(self.bound_env) if callable(val) else val
+            zero_div = generated_div_non_zero_div_cond[0]
+            substitutions.append((self.hole_funcs[hole], expr))
+            substitutions.append((self.div_funcs[hole], BoolVal(True) if zero_div is True else zero_div))
+        return substitute_funs(formula, *substitutions)
+
+    def solver_params(self):
+        """
+        The Z3 limits of the next query: the per-candidate timeout, capped by
+        what is left until the deadline, and the rlimit. Raises
+        SynthesisTimeout once the deadline has passed.
+        """
+        timeout = self.limits.get('timeout')
+        if self.limits.get('deadline') is not None:
+            left = int((self.limits['deadline'] - time.monotonic()) * 1000)
+            if left <= 0:
+                raise SynthesisTimeout("Timed out!")
+            timeout = left if timeout is None else min(timeout, left)
+        # 0 lifts the limit again after a limited check
+        return {'timeout': timeout or 0, 'rlimit': self.limits.get('rlimit') or 0}
+
+    def check(self, candidate, conjuncts=None, bounds=None):
+        """
+        Returns a model if the candidate fills the holes, else None. Whether
+        the solver refuted the candidate or gave up on it (timeout, rlimit)
+        is left in `last_status`.
+        """
+        formula = self.instantiate(candidate, conjuncts)
+        if bounds:
+            formula = substitute(formula, *[(Bool(name), BoolVal(val)) for name, val in bounds.items()])
+        self.checks += 1
+        self.solver.set(**self.solver_params())
+        self.solver.push()
+        try:
+            if self.backend == 'cegis':
+                return self.check_cegis(formula)
+            query = ForAll(self.quantified, formula)
+            subgoals = preprocess_query([query], self.preprocess, self.preprocess_counters) if self.preprocess else None
+            if subgoals is not None:
+                return self.check_subgoals(subgoals)
+            self.solver.add(query)
+            self.last_status = self.solver.check()
+            if self.last_status == sat:
+                return self.solver.model()
+        finally:
+            self.solver.pop()
+
+    def check_subgoals(self, subgoals):
+        # the query holds iff one of the subgoals does; unknown only if none is sat
+        statuses = []
+        for goal in subgoals:
+            self.solver.push()
+            try:
+                self.solver.add(*goal)
+                statuses.append(self.solver.check())
+                if statuses[-1] == sat:
+                    self.last_status = sat
+                    return goal.convert_model(self.solver.model())
+            finally:
+                self.solver.pop()
+        self.last_status = unknown if unknown in statuses else unsat
+        return None
+
+    def check_cegis(self, formula):
+        quantified_names = {str(v) for v in self.quantified}
+        hole_consts = [c for c in get_free_consts(formula) if str(c) not in quantified_names]
+        for example in self.examples:
+            self.solver.add(substitute(formula, *example))
+
+        for _ in range(self.max_cegis_iterations):
+            self.cegis_iterations += 1
+            self.last_status = self.solver.check()
+            if self.last_status != sat:
+                return None
+            model = self.solver.model()
+            fixed = [(c, model.eval(c, model_completion=True)) for c in hole_consts]
+            verifier = Solver()
+            verifier.set(**self.solver_params())
+            verifier.add(Not(substitute(formula, *fixed)))
+            self.last_status = verifier.check()
+            if self.last_status == unsat:
+                self.last_status = sat
+                return model
+            if self.last_status == unknown:
+                return None
+            counterexample = verifier.model()
+            example = [(v, counterexample.eval(v, model_completion=True)) for v in self.quantified]
+            self.examples.append(example)
+            self.solver.add(substitute(formula, *example))
+        return None  # gave up on this candidate
+
+
+class DeepeningSession:
+    """
+    Candidate checks with iterative deepening of the loop unrolling. Every
+    loop starts unrolled once; the loop left after the unrolled copies
+    carries a bound literal (see preProcess) which, when assumed, accepts
+    the runs that need more iterations than were unrolled.
+
+    A candidate is checked with all bound literals off. If that fails but
+    succeeds once the bounds are assumed, the failure is blamed on the
+    bounds: the loops whose literal alone makes the query satisfiable (all
+    of them if none does) are unrolled once more and the candidate is checked
+    again. Depths only grow, up to `max_depth`, so later candidates start
+    from the depths reached so far. The sessions of all unrollings share one
+    solver and WP cache.
+    """
+
+    def __init__(self, P, ast, Q, linv, original_names, hole_names, backend='forall', encoding='wp', max_depth=16):
+        self.make_session = partial(SynthesisSession, P, Q=Q, linv=linv, original_names=original_names,
+                                    hole_names=hole_names, backend=backend, encoding=encoding)
+        self.ast = ast
+        self.max_depth = max_depth
+        self.depths = [1] * count_loops(ast)
+        self.sessions = {}
+        self.limits = {}
+        self.preprocess = None
+        self.preprocess_counters = {}
+
+    def session(self):
+        depths = tuple(self.depths)
+        if depths not in self.sessions:
+            bounds = []
+            ast = preProcess(deepcopy(self.ast), depths, bounds)
+            reuse = next(iter(self.sessions.values()), (None,))[0]
+            session = self.make_session(ast=ast, reuse=reuse)
+            session.limits = self.limits
+            session.preprocess, session.preprocess_counters = self.preprocess, self.preprocess_counters
+            self.sessions[depths] = (session, bounds)
+        return self.sessions[depths]
+
+    @property
+    def checks(self):
+        return sum(session.checks for session, _ in self.sessions.values())
+
+    @property
+    def cegis_iterations(self):
+        return sum(session.cegis_iterations for session, _ in self.sessions.values())
+
+    @property
+    def wp_cache(self):
+        return self.session()[0].wp_cache
+
+    @property
+    def template(self):
+        return self.session()[0].template
+
+    @property
+    def last_status(self):
+        return self.session()[0].last_status
+
+    def check(self, candidate):
+        while True:
+            session, bounds = self.session()
+            off = {name: False for name in bounds}
+            sol = session.check(candidate, bounds=off)
+            if sol is not None or session.last_status == unknown:
+                return sol
+            growable = [i for i, depth in enumerate(self.depths) if depth < self.max_depth]
+            if not growable or session.check(candidate, bounds={**off, **{bounds[i]: True for i in growable}}) is None:
+                return None  # no deeper unrolling can make this candidate work
+            blamed = [i for i in growable if session.check(candidate, bounds={**off, bounds[i]: True}) is not None]
+            for i in blamed or growable:
+                self.depths[i] += 1
+
+
+class HoleExpr:
+    """
+    A candidate expression for a hole, kept as an AST with the node kinds of
+    the parser's expressions, plus 'const' for a fresh integer picked by the
+    solver. Calling it with an environment encodes it like any other
+    expression; its division side conditions are left in
+    `generated_div_non_zero_div_cond` for the enclosing `encode_expr`.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def __call__(self, e):
+        global generated_div_non_zero_div_cond
+        expr, zero_div = encode_expr(self.tree, e)
+        generated_div_non_zero_div_cond[0] = zero_div
+        return expr
+
+
 def create_first_phase(orig_names, hole_names, i):
-    f = lambda name, e: e[name]
     possible_hole_expr = []
     for hole_name in hole_names:
         possible_hole_expr.append(
-            [partial(lambda n, e: Int(f'{n}_{i}'), hole_name)] + [partial(f, name) for name in orig_names])
-    return tuple(product(*possible_hole_expr))
+            [HoleExpr(adt.tree.Tree('const', [adt.tree.Tree(f'{hole_name}_{i}')]))] +
+            [HoleExpr(get_id_ast(name)) for name in orig_names])
+    return product(*possible_hole_expr)
 
 
-def div_phase(val1, val2, e):
-    global generated_div_non_zero_div_cond
-    under = val2(e)
-    generated_div_non_zero_div_cond[0] = And(under != 0, generated_div_non_zero_div_cond[0])
-    return val1(e) / val2(e)
-
-
-def create_next_phase(past_phase, orig_names, hole_name, phase_num):
-    phase = []
+def create_next_phase(past_phase, orig_names, hole_name, phase_num, break_symmetry=False):
     for vals1 in past_phase:
         for vals2 in create_first_phase(orig_names, hole_name, phase_num):
-            phase.append(tuple(map(lambda vals:
-                                   partial(lambda val1, val2, e: val1(e) + val2(e), vals[0], vals[1]),
-                                   zip(vals1, vals2)))
-                         )
-            phase.append(tuple(map(lambda vals:
-                                   partial(lambda val1, val2, e: val1(e) - val2(e), vals[0], vals[1]),
-                                   zip(vals1, vals2)))
-                      )
-            phase.append(tuple(map(lambda vals:
-                                   partial(lambda val1, val2, e: val1(e) * val2(e), vals[0], vals[1]),
-                                   zip(vals1, vals2)))
-
-                )
-            phase.append(tuple(map(lambda vals:
-                                   partial(div_phase,vals[0],vals[1]),
-                                   zip(vals1, vals2)))
-                )
-
-    return phase
-
-
-def gen_holes(P, ast, Q, linv, program, withExprs=True):
-    original_names = find_all_vars(ast)
-    hole_names = []
-    ast = find_and_replace_holes(ast, hole_names)
-    ast = preProcess(ast)
+            for op in ['+', '-', '*', '/']:
+                if break_symmetry and redundant_candidate(op, vals1, vals2, orig_names):
+                    continue
+                yield tuple(HoleExpr(adt.tree.Tree(op, [val1.tree, val2.tree])) for val1, val2 in zip(vals1, vals2))
 
-    env = mk_env(original_names + hole_names)
 
-    sol = None
+def constant_expr(op, left, right):
+    """
+    Whether op(left, right) computes a constant wherever it is defined: it
+    mentions no variable, or it is e - e, e / e or e * 0.
+    """
+    if not any(node.root == 'id' for node in left.nodes + right.nodes):
+        return True
+    if op in ('-', '/') and left == right:
+        return True
+    return op == '*' and any(t.root == 'num' and t.subtrees[0].root == 0 for t in (left, right))
 
-    current_phase = create_first_phase(original_names, hole_names, 0)
-    i = 0
-    phase_num = 0
-    while sol is None and phase_num < 10:
 
-        env = mk_env(original_names + hole_names)
-        if withExprs:
-            if i == len(current_phase):
-                i = 0
-                phase_num += 1
+def leaf_rank(tree, orig_names):
+    # the position of a first phase expression: the constant, then the variables
+    return 0 if tree.root == 'const' else 1 + orig_names.index(tree.subtrees[0].root)
+
+
+def redundant_candidate(op, vals1, vals2, orig_names):
+    """
+    Whether the candidate op(vals1[i], vals2[i]) of create_next_phase is
+    equivalent to one the enumeration keeps, given that the holes of a
+    candidate share their operator and a later phase only adds a first
+    phase expression on the right:
+      * every hole gets a constant (see constant_expr), which the
+        solver-picked constants of the first phase cover;
+      * every hole subtracts a solver-picked constant, the same as adding
+        it with the opposite sign;
+      * a commutative operator takes two first phase expressions out of
+        the canonical order (`leaf_rank`), the swapped candidate is kept.
+    Commutative operators on a larger expression are always canonical, the
+    enumeration never puts it on the right.
+    """
+    pairs = [(val1.tree, val2.tree) for val1, val2 in zip(vals1, vals2)]
+    if all(constant_expr(op, left, right) for left, right in pairs):
+        return True
+    if op == '-' and all(right.root == 'const' for _, right in pairs):
+        return True
+    return op in ('+', '*') and any(left.root in ('id', 'const') and
+                                    leaf_rank(left, orig_names) > leaf_rank(right, orig_names)
+                                    for left, right in pairs)
+
+
+def int_div(a, b):
+    # integer division as Z3 defines it: the remainder is never negative
+    return a // b if b > 0 else -(a // -b)
+
+
+def eval_hole_expr(tree, values):
+    """
+    Evaluates a hole expression on concrete values (for the variables and
+    the 'const' leaves). Returns None if it divides by zero.
+    """
+    if tree.root in ('id', 'const'):
+        return values[tree.subtrees[0].root]
+    elif tree.root == 'num':
+        return tree.subtrees[0].root
+    left = eval_hole_expr(tree.subtrees[0], values)
+    right = eval_hole_expr(tree.subtrees[1], values)
+    if left is None or right is None:
+        return None
+    if tree.root == '/':
+        return int_div(left, right) if right != 0 else None
+    return OP[tree.root](left, right)
+
+
+def sample_points(original_names, examples=(), count=4):
+    """
+    Concrete states used to tell candidate expressions apart: the known
+    input examples (variables they leave out get arbitrary values) followed
+    by `count` fixed pseudo-random states. Each state comes with values for
+    the fresh constants of an expression, in order of appearance.
+    """
+    rand = random.Random(0)
+    points = []
+    for example in list(examples) + [{}] * count:
+        values = {name: example[name] if name in example else rand.randint(-20, 20) for name in original_names}
+        points.append((values, [rand.randint(-20, 20) for _ in range(16)]))
+    return points
+
+
+def expr_fingerprint(tree, points):
+    """
+    The outputs of a hole expression on the sample points. Constants are
+    numbered by order of appearance, so `hole0_0 + a` and `a + hole0_1` get
+    the same outputs.
+    """
+    consts = []
+    for node in tree.nodes:
+        if node.root == 'const' and node.subtrees[0].root not in consts:
+            consts.append(node.subtrees[0].root)
+    outputs = []
+    for values, const_values in points:
+        values = dict(values, **{name: const_values[j % len(const_values)] for j, name in enumerate(consts)})
+        outputs.append(eval_hole_expr(tree, values))
+    return tuple(outputs)
+
+
+INT64_MIN = -2 ** 63
+
+
+def eval_columns(tree, variables, consts, cache=None):
+    """
+    Vectorized `eval_hole_expr`: evaluates a hole expression on many states
+    at once. `variables` maps every variable to an int64 array with one
+    entry per state, and row j of the int64 matrix `consts` holds the
+    values of the j-th fresh constant of the expression (numbered by order
+    of appearance, as in `expr_fingerprint`). Returns the results and a
+    boolean mask of the states where they are defined: nothing divides by
+    zero or overflows 64 bits. `cache` (a dict, valid for the same
+    `variables` and `consts`) keeps the results of subtrees between calls.
+    """
+    order = []
+    for node in tree.nodes:
+        if node.root == 'const' and node.subtrees[0].root not in order:
+            order.append(node.subtrees[0].root)
+    index = {name: j % len(consts) for j, name in enumerate(order)}
+    cache = {} if cache is None else cache
+
+    def evaluate(t):
+        # the same subtree means different columns under a different numbering of its constants
+        key = (t, tuple(index[n.subtrees[0].root] for n in t.nodes if n.root == 'const'))
+        if key in cache:
+            return cache[key]
+        if t.root == 'id':
+            values, valid = variables[t.subtrees[0].root], numpy.ones(len(consts[0]), dtype=bool)
+        elif t.root == 'const':
+            values, valid = consts[index[t.subtrees[0].root]], numpy.ones(len(consts[0]), dtype=bool)
+        elif t.root == 'num':
+            values, valid = numpy.full(len(consts[0]), t.subtrees[0].root, dtype=numpy.int64), \
+                numpy.ones(len(consts[0]), dtype=bool)
+        else:
+            (a, a_valid), (b, b_valid) = evaluate(t.subtrees[0]), evaluate(t.subtrees[1])
+            values, overflow = eval_op_columns(t.root, a, b)
+            valid = a_valid & b_valid & ~overflow
+        cache[key] = values, valid
+        return values, valid
+
+    return evaluate(tree)
+
+
+def eval_op_columns(op, a, b):
+    """
+    Applies an operator of the OP table to two int64 arrays. Returns the
+    results and a mask of the entries that are undefined: a division by
+    zero, or a result that wrapped around (the results there are garbage).
+    Comparisons come back as 0/1.
+    """
+    with numpy.errstate(all='ignore'):
+        if op == '+':
+            values = a + b
+            return values, ((a ^ values) & (b ^ values)) < 0
+        elif op == '-':
+            values = a - b
+            return values, ((a ^ b) & (a ^ values)) < 0
+        elif op == '*':
+            values = a * b
+            safe_a = numpy.where(a == 0, 1, a)
+            return values, ((a != 0) & (values // safe_a != b)) | ((a == -1) & (b == INT64_MIN)) | \
+                ((b == -1) & (a == INT64_MIN))
+        elif op == '/':
+            # int_div: the remainder is never negative; -INT64_MIN does not fit
+            safe_b = numpy.where((b == 0) | (b == INT64_MIN), 1, b)
+            values = numpy.where(safe_b > 0, a // safe_b, -(a // -safe_b))
+            return values, (b == 0) | (b == INT64_MIN) | ((a == INT64_MIN) & (b == -1))
+        return OP[op](a, b).astype(numpy.int64), numpy.zeros(len(a), dtype=bool)
+
+
+def point_columns(points):
+    """
+    The sample points as columns for `eval_columns`: the variables and the
+    constants. None if a value does not fit in 64 bits.
+    """
+    try:
+        variables = {name: numpy.array([values[name] for values, _ in points], dtype=numpy.int64)
+                     for name in points[0][0]}
+        consts = numpy.array([const_values for _, const_values in points], dtype=numpy.int64).T
+    except OverflowError:
+        return None
+    return variables, consts
+
+
+def prune_equivalent_candidates(phase, phase_num, points, seen, vectorized=None, chunk=4096):
+    """
+    Drops every candidate whose holes compute the same outputs on `points`
+    as an earlier candidate. `seen` maps every fingerprint to the position
+    (phase, index) of the candidate kept for it and is shared between
+    phases, so larger expressions equivalent to smaller ones are dropped as
+    well, and generating a phase again keeps the same representatives.
+    With NumPy (`vectorized`, by default if it is installed), the
+    fingerprints of `chunk` candidates at a time are computed column-wise
+    over all the points; a candidate of a later phase then mostly costs
+    one array operation per hole, as its subexpressions are cached.
+    """
+    columns = point_columns(points) if (numpy is not None if vectorized is None else vectorized) else None
+    if columns is None:
+        for index, candidate in enumerate(phase):
+            key = tuple(expr_fingerprint(val.tree, points) for val in candidate)
+            if seen.setdefault(key, (phase_num, index)) == (phase_num, index):
+                yield candidate
+        return
+
+    index = 0
+    phase = iter(phase)
+    while True:
+        candidates = list(islice(phase, chunk))
+        if not candidates:
+            return
+        cache = {}
+        for candidate in candidates:
+            key = []
+            for val in candidate:
+                values, valid = eval_columns(val.tree, *columns, cache)
+                key.append(numpy.where(valid, values, 0).tobytes() + valid.tobytes())
+            if seen.setdefault(tuple(key), (phase_num, index)) == (phase_num, index):
+                yield candidate
+            index += 1
+
+
+class ConcreteFailure(Exception):
+    pass
+
+
+class OutOfFuel(Exception):
+    pass
+
+
+def compile_expr(tree, holes):
+    """
+    Compiles an expression into a function of a concrete state (a dict from
+    variable names to ints). Reading a name in `holes` calls the function
+    the dict holds for it at that time. Division by zero raises
+    ConcreteFailure.
+    """
+    if tree.root == 'id':
+        name = tree.subtrees[0].root
+        if name in holes:
+            return lambda s: holes[name](s)
+        return lambda s: s[name]
+    elif tree.root == 'num':
+        value = tree.subtrees[0].root
+        return lambda s: value
+    elif tree.root in OP:
+        left, right = compile_expr(tree.subtrees[0], holes), compile_expr(tree.subtrees[1], holes)
+        if tree.root == '/':
+            def divide(s):
+                a, b = left(s), right(s)
+                if b == 0:
+                    raise ConcreteFailure()
+                return int_div(a, b)
+
+            return divide
+        op = OP[tree.root]
+        return lambda s: op(left(s), right(s))
+    raise SyntaxError
+
+
+def compile_command(ast, holes, fuel):
+    """
+    Compiles a command into a function that runs it on a concrete state in
+    place. Every loop iteration takes one unit from `fuel` (a one-element
+    list) and OutOfFuel is raised when it runs out; a failing assertion
+    raises ConcreteFailure.
+    """
+    if ast.root == ';':
+        first, second = compile_command(ast.subtrees[0], holes, fuel), compile_command(ast.subtrees[1], holes, fuel)
+
+        def sequence(s):
+            first(s)
+            second(s)
+
+        return sequence
+    elif ast.root == 'skip':
+        return lambda s: None
+    elif ast.root == ':=':
+        name = ast.subtrees[0].subtrees[0].root
+        expr = compile_expr(ast.subtrees[1], holes)
+
+        def assign(s):
+            s[name] = expr(s)
+
+        return assign
+    elif ast.root == 'if':
+        cond = compile_expr(ast.subtrees[0], holes)
+        then, otherwise = compile_command(ast.subtrees[1], holes, fuel), compile_command(ast.subtrees[2], holes, fuel)
+        return lambda s: then(s) if cond(s) else otherwise(s)
+    elif ast.root == 'while':
+        cond = compile_expr(ast.subtrees[0], holes)
+        body = compile_command(ast.subtrees[1], holes, fuel)
+
+        def loop(s):
+            while cond(s):
+                fuel[0] -= 1
+                if fuel[0] < 0:
+                    raise OutOfFuel()
+                body(s)
+
+        return loop
+    elif ast.root == 'assert':
+        cond = compile_expr(ast.subtrees[0], holes)
 
-                current_phase = create_next_phase(current_phase, original_names, hole_names, phase_num)
+        def check(s):
+            if not cond(s):
+                raise ConcreteFailure()
 
-            for hole, val in zip(hole_names, current_phase[i]):
-                env[hole] = val
+        return check
+    raise SyntaxError
 
+
+def holds(assertion, state):
+    """
+    Evaluates P or Q on a concrete state: True, False, or None if it cannot
+    be decided without the solver.
+    """
+    try:
+        value = assertion(state)
+    except Exception:
+        return None
+    if is_expr(value):
+        value = simplify(value)
+        return True if is_true(value) else False if is_false(value) else None
+    return bool(value)
+
+
+class ConcreteFilter:
+    """
+    Runs candidates on concrete states before they reach the solver. The
+    sketch (its real loops, not the unrolled ones) is compiled once into
+    Python closures; a candidate only fills in the holes. The states are the
+    sample points (the known inputs first) that satisfy P. A candidate that
+    divides by zero, fails an assertion or ends in a state violating Q on
+    one of them cannot satisfy the ForAll query and is rejected. Candidates
+    with solver-picked constants, runs that use up `fuel` loop iterations
+    and assertions that do not evaluate to a constant are left to the
+    solver.
+    """
+
+    def __init__(self, sketch, original_names, hole_names, P, Q, examples=(), fuel=10000):
+        self.hole_names = hole_names
+        self.holes = {hole: None for hole in hole_names}
+        self.fuel_limit = fuel
+        self.fuel = [fuel]
+        self.program = compile_command(sketch, self.holes, self.fuel)
+        specs = list(zip(P, Q)) if isinstance(P, list) else [(P, Q)]
+        points = [values for values, _ in sample_points(original_names, examples)]
+        self.runs = [(values, q) for p, q in specs for values in points if holds(p, values) is True]
+        self.rejected = 0
+
+    def refutes(self, candidate):
+        if not all(isinstance(val, HoleExpr) and all(n.root != 'const' for n in val.tree.nodes) for val in candidate):
+            return False
+        for hole, val in zip(self.hole_names, candidate):
+            self.holes[hole] = compile_expr(val.tree, {})
+        for values, q in self.runs:
+            state = dict(values)
+            self.fuel[0] = self.fuel_limit
+            try:
+                self.program(state)
+            except ConcreteFailure:
+                self.rejected += 1
+                return True
+            except OutOfFuel:
+                continue
+            if holds(q, state) is False:
+                self.rejected += 1
+                return True
+        return False
+
+
+class CandidateStream:
+    """
+    Lazily enumerates the candidate tuples of gen_holes, phase after phase.
+    No phase is ever materialized: phase n is built from a fresh generator
+    of phase n-1, so memory does not grow with the size of the phases.
+    `cursor` is the (phase, index) of the next candidate; it can be saved
+    with `save_checkpoint` and passed back to resume a search. With
+    `break_symmetry` the candidates that redundant_candidate finds
+    equivalent to others are never generated.
+    """
+
+    def __init__(self, original_names, hole_names, prune_points=None, cursor=(0, 0), max_phase=10,
+                 break_symmetry=True):
+        self.original_names = original_names
+        self.hole_names = hole_names
+        self.prune_points = prune_points
+        self.break_symmetry = break_symmetry
+        self.cursor = tuple(cursor)
+        self.max_phase = max_phase
+        self.seen = {}
+        self.complete = set()  # phases whose fingerprints are all in `seen`
+
+    def generate(self, phase_num):
+        if phase_num == 0:
+            phase = create_first_phase(self.original_names, self.hole_names, 0)
+        else:
+            phase = create_next_phase(self.generate(phase_num - 1), self.original_names, self.hole_names,
+                                      phase_num, self.break_symmetry)
+        if self.prune_points is not None:
+            phase = prune_equivalent_candidates(phase, phase_num, self.prune_points, self.seen)
+        yield from phase
+        self.complete.add(phase_num)
+
+    def iter_phase(self, phase_num):
+        if self.prune_points is not None:
+            # which candidate represents a class depends on all the phases before it
+            for earlier in range(phase_num):
+                if earlier not in self.complete:
+                    for _ in self.generate(earlier):
+                        pass
+        return self.generate(phase_num)
+
+    def candidate_at(self, phase_num, index):
+        return next(islice(self.iter_phase(phase_num), index, None))
+
+    def __iter__(self):
+        phase_num, index = self.cursor
+        while phase_num < self.max_phase:
+            for candidate in islice(self.iter_phase(phase_num), index, None):
+                index += 1
+                self.cursor = (phase_num, index)
+                yield candidate
+            phase_num, index = phase_num + 1, 0
+            self.cursor = (phase_num, index)
+
+
+def save_checkpoint(path, program, original_names, cursor):
+    with open(path, 'w') as f:
+        json.dump({'program': program, 'names': original_names, 'phase': cursor[0], 'index': cursor[1]}, f)
+
+
+def load_checkpoint(path, program):
+    """
+    Returns the variable order and the cursor saved for `program`, or None
+    if there is no checkpoint for it. The variable order is saved because
+    `find_all_vars` does not guarantee one between runs.
+    """
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        saved = json.load(f)
+    if saved['program'] != program:
+        return None
+    return saved['names'], (saved['phase'], saved['index'])
+
+
+def group_dependent_holes(hole_names, conjuncts):
+    """
+    Partitions the holes into groups that share no conjunct, in program
+    order. Holes in different groups can be searched independently.
+    """
+    group_of = {hole: {hole} for hole in hole_names}
+    for _, holes in conjuncts:
+        merged = set().union(*[group_of[hole] for hole in holes]) if holes else set()
+        for hole in merged:
+            group_of[hole] = merged
+    groups = []
+    for hole in hole_names:
+        if group_of[hole] not in groups:
+            groups.append(group_of[hole])
+    return [sorted(group, key=hole_names.index) for group in groups]
+
+
+def assign_holes(session, holes, prefix, conjuncts, depth, prune_points, break_symmetry=True):
+    """
+    Depth first search over the holes of a group, in program order. A hole's
+    candidate is checked together with the fixed prefix against the
+    conjuncts that only mention holes assigned so far; the search backtracks
+    when no candidate of up to `depth` phases works.
+    """
+    if len(prefix) == len(holes):
+        return prefix
+    hole = holes[len(prefix)]
+    fixed = set(prefix) | {hole}
+    relevant = [c for c, used in conjuncts if used <= fixed]
+    constrained = any(hole in used for _, used in conjuncts if used <= fixed)
+    for (val,) in CandidateStream(session.original_names, [hole], prune_points, max_phase=depth + 1,
+                                  break_symmetry=break_symmetry):
+        assignment = dict(prefix, **{hole: val})
+        if constrained and session.check(assignment, relevant) is None:
+            continue
+        found = assign_holes(session, holes, assignment, conjuncts, depth, prune_points, break_symmetry)
+        if found is not None:
+            return found
+    return None
+
+
+def search_decomposed(session, prune_points=None, max_phase=10, break_symmetry=True):
+    """
+    Searches the holes group by group instead of through the product of all
+    their candidates (see `assign_holes`), deepening the candidate phases
+    allowed per hole until a group is solved. Returns a dict from hole to
+    its expression, or None.
+    """
+    conjuncts = session.split_conjuncts()
+    assignment = {}
+    for holes in group_dependent_holes(session.hole_names, conjuncts):
+        group_conjuncts = [(c, used) for c, used in conjuncts if not used or used & set(holes)]
+        depth = 0
+        while depth < max_phase:
+            found = assign_holes(session, holes, {}, group_conjuncts, depth, prune_points, break_symmetry)
+            if found is not None:
+                assignment.update(found)
+                break
+            depth += 1
+        else:
+            return None
+    return assignment
+
+
+search_worker_state = {}
+
+
+def init_search_worker(P, ast, Q, linv, original_names, hole_names, backend, prune_points, encoding='wp',
+                       limits=None, concrete=None, preprocess=None, break_symmetry=True):
+    # runs once in every forked worker, which therefore owns its own copy of the Z3 context
+    search_worker_state['session'] = SynthesisSession(P, ast, Q, linv, original_names, hole_names, backend,
+                                                      encoding=encoding)
+    search_worker_state['session'].limits = limits or {}
+    search_worker_state['session'].preprocess = preprocess
+    search_worker_state['stream'] = CandidateStream(original_names, hole_names, prune_points,
+                                                    break_symmetry=break_symmetry)
+    search_worker_state['concrete'] = concrete
+    search_worker_state['position'] = None
+
+
+def check_candidates_range(task):
+    phase_num, start, end = task
+    # workers enumerate the candidates themselves, only indices cross processes
+    position = search_worker_state['position']
+    if position is None or position[0] != phase_num or position[1] > start:
+        position = (phase_num, 0, search_worker_state['stream'].iter_phase(phase_num))
+    _, index, candidates = position
+
+    for i, candidate in enumerate(islice(candidates, start - index, end - index), start):
+        search_worker_state['position'] = (phase_num, i + 1, candidates)
+        if search_worker_state['concrete'] is not None and search_worker_state['concrete'].refutes(candidate):
+            continue
         try:
-            sol = find_sol(P, ast, Q, linv, env, original_names)
-        except Exception as e:
+            sol = search_worker_state['session'].check(candidate)
+        except Exception:
             sol = None
-            # print("fake none")
-        # print(sol)
-        i += 1
+        if sol is not None:
+            return i
+    search_worker_state['position'] = (phase_num, end, candidates)
+    return None
+
+
+def search_phase_in_parallel(pool, stream, phase_num, start, workers, deterministic, deadline=None):
+    """
+    Shards the candidates of a phase (from index `start`) across the pool and
+    returns the index of a satisfying one (the lowest such index if
+    `deterministic`), or None. Raises SynthesisTimeout if the results are
+    not in by `deadline` (a time.monotonic() value).
+    """
+    phase_size = sum(1 for _ in stream.iter_phase(phase_num))
+    chunk = max(1, (phase_size - start) // (workers * 4))
+    tasks = [(phase_num, i, min(i + chunk, phase_size)) for i in range(start, phase_size, chunk)]
+    results = pool.imap(check_candidates_range, tasks) if deterministic \
+        else pool.imap_unordered(check_candidates_range, tasks)
+    for _ in tasks:
+        try:
+            found = results.next(None if deadline is None else max(0, deadline - time.monotonic()))
+        except multiprocessing.TimeoutError:
+            raise SynthesisTimeout("Timed out!")
+        if found is not None:
+            return found
+    return None
+
+
+def canonical_assertion(assertion, env):
+    formula = assertion(env)
+    formula = formula if is_expr(formula) else BoolVal(formula)
+    return sorted(c.sexpr() for c in flatten_conjuncts(simplify(formula)))
+
+
+class ResultCache:
+    """
+    Synthesis results kept in an SQLite file across runs. The key is the
+    sketch's AST as parsed (so layout and comments do not matter), P, Q and
+    the loop invariant rendered as sorted conjuncts over the program
+    variables, and the options that change the answer. Only the hole
+    fillings are stored: a hit is replayed into the caller's program text.
+
+    Once the entries take more than `max_bytes` the least recently used
+    ones are evicted. Searches that found nothing are cached only with
+    `cache_negative`.
+    """
+
+    def __init__(self, path, max_bytes=64 * 2 ** 20, cache_negative=False):
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS results '
+                        '(key TEXT PRIMARY KEY, fillings TEXT, result TEXT, size INTEGER, used INTEGER)')
+        self.max_bytes = max_bytes
+        self.cache_negative = cache_negative
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, ast, P, Q, linv, withExprs, unroll_depth=7, deepen=False):
+        """
+        Returns the key of a query, or None if its assertions mention
+        variables the sketch does not have (such queries are not cached).
+        """
+        env = mk_env(find_all_vars(ast))
+        try:
+            examples = [[canonical_assertion(p, env), canonical_assertion(q, env)]
+                        for p, q in (zip(P, Q) if isinstance(P, list) else [(P, Q)])]
+            spec = [repr(ast), examples, canonical_assertion(linv, env), withExprs, unroll_depth, deepen]
+        except KeyError:
+            return None
+        return hashlib.sha256(json.dumps(spec).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Returns (fillings, None) for a cached program, (None, result) for a
+        cached failure, or None.
+        """
+        row = self.db.execute('SELECT fillings, result FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self.db:
+            self.db.execute('UPDATE results SET used = (SELECT MAX(used) + 1 FROM results) WHERE key = ?', (key,))
+        return (None if row[0] is None else json.loads(row[0])), row[1]
+
+    def put(self, key, fillings=None, result=None):
+        if fillings is None and not self.cache_negative:
+            return
+        fillings = None if fillings is None else json.dumps(fillings)
+        size = len(key) + len(fillings or result or '')
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO results VALUES '
+                            '(?, ?, ?, ?, (SELECT COALESCE(MAX(used), 0) + 1 FROM results))',
+                            (key, fillings, result, size))
+            self.evict()
+
+    def evict(self):
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        for key, size in self.db.execute('SELECT key, size FROM results ORDER BY used').fetchall():
+            if total <= self.max_bytes:
+                break
+            self.db.execute('DELETE FROM results WHERE key = ?', (key,))
+            total -= size
+            self.evictions += 1
+
+    def counters(self):
+        return {'cache_hits': self.hits, 'cache_misses': self.misses, 'cache_evictions': self.evictions}
+
+    def close(self):
+        self.db.close()
+
+
+class PartialResult:
+    """
+    What gen_holes returns instead of a program when its deadline passes:
+    the phase the search reached, the candidates it checked and the ones
+    that timed out and were still waiting for another try.
+    """
+
+    def __init__(self, phase, tried, pending, elapsed):
+        self.phase = phase
+        self.tried = tried
+        self.pending = pending
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return f'PartialResult(phase={self.phase}, tried={self.tried}, pending={self.pending}, ' \
+               f'elapsed={self.elapsed:.2f})'
+
+
+def gen_holes(P, ast, Q, linv, program, withExprs=True, incremental=True, workers=1, deterministic=True,
+              backend='forall', stats=None, prune_equivalent=False, examples=(), checkpoint=None,
+              checkpoint_every=100, search='phases', encoding='wp', unroll_depth=7, deepen=False,
+              max_unroll_depth=16, deadline=None, candidate_timeout=None, candidate_rlimit=None, max_phase=None,
+              retry_factor=10, cache=None, concrete_filter=True, fuel=10000, portfolio=None, preprocess=None,
+              break_symmetry=True):
+    cache_key = None if cache is None else cache.key(ast, P, Q, linv, withExprs, unroll_depth, deepen)
+    if cache_key is not None:
+        cached = cache.get(cache_key)
+        if stats is not None:
+            stats['cache'] = 'miss' if cached is None else 'hit'
+            stats.update(cache.counters())
+        if cached is not None:
+            fillings, result = cached
+            return result if fillings is None else fill_holes(program, fillings)
+
+    started = time.monotonic()
+    limits = {'deadline': None if deadline is None else started + deadline,
+              'timeout': candidate_timeout, 'rlimit': candidate_rlimit}
+    limited = deadline is not None or candidate_timeout is not None or candidate_rlimit is not None
+    if max_phase is None:
+        # with a deadline the search goes on until the time is up
+        max_phase = float('inf') if deadline is not None else 10
+
+    original_names = find_all_vars(ast)
+    hole_names = []
+    ast = find_and_replace_holes(ast, hole_names)
+    if deepen and (workers > 1 or search == 'decomposed'):
+        raise ValueError("deepen is only supported by the sequential search")
+    sketch = deepcopy(ast)
+    ast = preProcess(ast, unroll_depth)
+
+    cursor = (0, 0)
+    resumed = load_checkpoint(checkpoint, program)
+    if resumed is not None and set(resumed[0]) == set(original_names):
+        original_names, cursor = resumed
+
+    prune_points = sample_points(original_names, examples) if prune_equivalent else None
+    stream = CandidateStream(original_names, hole_names, prune_points, cursor, max_phase, break_symmetry)
+    concrete = ConcreteFilter(sketch, original_names, hole_names, P, Q, examples, fuel) \
+        if withExprs and concrete_filter else None
+
+    # the solver limits bound every Z3 call, the alarm backs them up for the Python side (building WPs)
+    alarm = deadline is not None and threading.current_thread() is threading.main_thread()
+    if alarm:
+        previous_handler = signal.signal(signal.SIGALRM, signal_handler)
+        signal.setitimer(signal.ITIMER_REAL, deadline)
+
+    session = None
+    pool = None
+    sol = None
+    candidate = None
+    tried = 0
+    deferred = []  # candidates the solver gave up on, checked again with larger limits
+    refuted = [False]  # whether check_candidate rejected its last candidate without the solver
+    wins = {}  # portfolio strategy -> number of queries it answered first
+    preprocessed = {}  # counters of preprocess_query
+    expired = False
+    try:
+        if deepen:
+            session = DeepeningSession(P, sketch, Q, linv, original_names, hole_names, backend, encoding,
+                                       max_unroll_depth)
+        # without expressions there is a single ForAll query anyway
+        # find_sol takes a single P and Q, examples always go through a session
+        # a portfolio races fresh solvers, which an incremental session does not have
+        elif (incremental and withExprs and not portfolio) or backend == 'cegis' \
+                or (withExprs and search == 'decomposed') or limited or isinstance(P, list):
+            session = SynthesisSession(P, ast, Q, linv, original_names, hole_names, backend, encoding=encoding)
+        if session is not None:
+            session.limits.update(limits)
+            session.preprocess, session.preprocess_counters = preprocess, preprocessed
+
+        def check_candidate(candidate):
+            refuted[0] = concrete is not None and concrete.refutes(candidate)
+            if refuted[0]:
+                return None
+            try:
+                if session is not None:
+                    return session.check(candidate)
+                env = mk_env(original_names + hole_names)
+                for hole, val in zip(hole_names, candidate):
+                    env[hole] = val
+                return find_sol(P, ast, Q, linv, env, original_names, encoding, portfolio, wins, preprocess,
+                                preprocessed)
+            except SynthesisTimeout:
+                raise
+            except Exception as e:
+                # print("fake none")
+                return None
+
+        def retry_deferred():
+            # low priority: the timed out candidates get one longer try before the next phase
+            retry_limits = {k: limits[k] and limits[k] * retry_factor for k in ('timeout', 'rlimit')}
+            session.limits.update(retry_limits)
+            try:
+                while deferred:
+                    retried = deferred.pop(0)
+                    found = check_candidate(retried)
+                    if found is not None:
+                        return retried, found
+            finally:
+                session.limits.update({k: limits[k] for k in retry_limits})
+            return None, None
+
+        if withExprs and workers > 1:
+            pool = multiprocessing.get_context('fork').Pool(
+                workers, initializer=init_search_worker,
+                initargs=(P, ast, Q, linv, original_names, hole_names, backend, prune_points, encoding, limits,
+                          concrete, preprocess, break_symmetry))
+
         if not withExprs:  # if no expr and sol not found on first time there is no sol
-            break
+            candidate = [Int(hole) for hole in hole_names]
+            sol = check_candidate(candidate)
+        elif search == 'decomposed':
+            assignment = search_decomposed(session, prune_points, stream.max_phase, break_symmetry)
+            if assignment is not None:
+                candidate = [assignment[hole] for hole in hole_names]
+                sol = check_candidate(candidate)
+        elif pool is not None:
+            phase_num, start = stream.cursor
+            while sol is None and phase_num < stream.max_phase:
+                # the workers only tell which candidate works, its model is recomputed here
+                found = search_phase_in_parallel(pool, stream, phase_num, start, workers, deterministic,
+                                                 limits['deadline'])
+                if found is not None:
+                    candidate = stream.candidate_at(phase_num, found)
+                    sol = check_candidate(candidate)
+                    stream.cursor = (phase_num, found + 1)
+                else:
+                    phase_num, start = phase_num + 1, 0
+                    stream.cursor = (phase_num, start)
+                    if checkpoint is not None:
+                        save_checkpoint(checkpoint, program, original_names, stream.cursor)
+        else:
+            phase_num = stream.cursor[0]
+            for candidate in stream:
+                if deferred and stream.cursor[0] != phase_num:
+                    retried, sol = retry_deferred()
+                    if sol is not None:
+                        candidate = retried
+                        break
+                phase_num = stream.cursor[0]
+                sol = check_candidate(candidate)
+                tried += 1
+                if sol is not None:
+                    break
+                if limited and not refuted[0] and session.last_status == unknown:
+                    deferred.append(candidate)
+                if checkpoint is not None and tried % checkpoint_every == 0:
+                    save_checkpoint(checkpoint, program, original_names, stream.cursor)
+            if sol is None and deferred:
+                candidate, sol = retry_deferred()
+    except SynthesisTimeout:
+        expired = True
+        sol = None
+        if checkpoint is not None:
+            save_checkpoint(checkpoint, program, original_names, stream.cursor)
+    finally:
+        if alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+        if pool is not None:
+            pool.terminate()  # cancels whatever the other workers are still checking
+    if checkpoint is not None and os.path.exists(checkpoint) and not expired:
+        os.remove(checkpoint)  # the search is over, there is nothing left to resume
+
+    if stats is not None:
+        stats['backend'] = backend
+        stats['search'] = search
+        stats['encoding'] = encoding
+        stats['phase'] = stream.cursor[0]
+        stats['tried'] = tried
+        if limited:
+            stats['deadline_hit'] = expired
+            stats['pending'] = len(deferred)
+        if prune_points is not None:
+            stats['distinct_candidates'] = len(stream.seen)
+        if concrete is not None:
+            stats['concrete_rejected'] = concrete.rejected
+        if portfolio:
+            stats['portfolio_wins'] = wins
+        if preprocess:
+            stats['preprocess'] = preprocessed
+        if session is not None:
+            stats['checks'] = session.checks
+            stats['cegis_iterations'] = session.cegis_iterations
+            stats.update(session.wp_cache.counters())
+            stats['formula_dag_size'], stats['formula_tree_size'] = formula_size(session.template)
+        if deepen:
+            stats['unroll_depths'] = list(session.depths)
+    if expired:
+        return PartialResult(stream.cursor[0], tried, len(deferred), time.monotonic() - started)
     if sol is None and withExprs:
+        if cache_key is not None:
+            cache.put(cache_key, result="timeout")
         return "timeout"
     if sol is None and not withExprs:
+        if cache_key is not None:
+            cache.put(cache_key, result="solution can't be found")
         return "solution can't be found"
     if sol is not None:
+        env = mk_env(original_names + hole_names)
+        for hole, val in zip(hole_names, candidate):
+            env[hole] = val
         print("there is an assignment:")
         print(sol)
+        if cache_key is not None:
+            cache.put(cache_key, hole_fillings(hole_names, sol, env))
         return replace_holes_with_sol(program, hole_names, sol, env)
     else:
         print("i cant fill your holes")
         return False
 
 
-def synthesize(program, inputs, outputs, withExprs=True):
-    P = lambda d: And(*[d[k] == v for k, v in inputs.items()]) if isinstance(inputs,dict) else inputs
-    Q = lambda d: And(*[d[k] == v for k, v in outputs.items()]) if isinstance(outputs,dict) else outputs
+def spec_assertion(values):
+    return lambda d: And(*[d[k] == v for k, v in values.items()]) if isinstance(values, dict) else values
+
+
+def synthesize(program, inputs, outputs=None, withExprs=True, **options):
+    """
+    `inputs` and `outputs` are dicts from variables to values, or Z3
+    assertions over the program variables (taking the environment). To fit
+    several examples at once, pass a list of (inputs, outputs) pairs as
+    `inputs` instead: all of them are encoded in one query in which only
+    the holes are shared.
+    """
+    if isinstance(inputs, list):
+        P = [spec_assertion(example_inputs) for example_inputs, _ in inputs]
+        Q = [spec_assertion(example_outputs) for _, example_outputs in inputs]
+        options.setdefault('examples', [i for i, _ in inputs if isinstance(i, dict) and i])
+    else:
+        P = spec_assertion(inputs)
+        Q = spec_assertion(outputs)
+        if isinstance(inputs, dict) and inputs:
+            options.setdefault('examples', [inputs])
     linv = lambda d: True
 
-    ast = WhileParser()(program)
-    fixed_program = gen_holes(P, ast, Q, linv, program, withExprs)
+    ast = parse(program)
+    fixed_program = gen_holes(P, ast, Q, linv, program, withExprs, **options)
 
     return fixed_program
 
 
-def synthesizeAndVerify(program, inputs, outputs, P, Q, linv, withExprs=True):
+def synthesizeAndVerify(program, inputs, outputs, P, Q, linv, withExprs=True, **options):
     inp = lambda d: And(*[d[k] == v for k, v in inputs.items()])
     out = lambda d: And(*[d[k] == v for k, v in outputs.items()])
-    ast = WhileParser()(program)
+    ast = parse(program)
     inp({"x": 3})
-    fixed_program = gen_holes(inp, ast, out, linv, program, withExprs)
-    new_ast = WhileParser()(fixed_program)
+    fixed_program = gen_holes(inp, ast, out, linv, program, withExprs, **options)
+    new_ast = parse(fixed_program) if isinstance(fixed_program, str) else None  # not a PartialResult
     if new_ast:
-        verify_result = verify(P, new_ast, Q, linv=linv)
+        verify_result = verify(P, new_ast, Q, linv=linv, portfolio=options.get('portfolio'),
+                               preprocess=options.get('preprocess'))
         return (fixed_program, verify_result)
     return (fixed_program, False)
 